@@ -20,4 +20,15 @@ def setup(app):
     app.add_config_value("kindlebuilder_title", "", "")
     app.add_config_value("kindlebuilder_cover_image", None, "")
     app.add_config_value("kindlebuilder_ignore_top_heading", True, "html")
+    app.add_config_value("kindlebuilder_compress_workers", 1, "")
+    app.add_config_value("kindlebuilder_compress_cache_size",
+                         64 * 1024 * 1024, "")
+    app.add_config_value("kindlebuilder_compression_level", "normal", "")
+    app.add_config_value("kindlebuilder_verify_output", False, "")
+    app.add_config_value("kindlebuilder_save_layout_plan", False, "")
+    app.add_config_value("kindlebuilder_output_mode", "stream", "")
+    app.add_config_value("kindlebuilder_fsync_output", False, "")
+    app.add_config_value("kindlebuilder_fragment_cache", True, "")
+    app.add_config_value("kindlebuilder_translate_workers", None, "")
+    app.add_config_value("kindlebuilder_doctree_prefetch", 32, "")
     app.add_builder(builder.KindleBuilder)
@@ -0,0 +1,171 @@
+/*
+ * C implementation of palm_compress.compress() and decompress().
+ *
+ * palm_compress loads this through ctypes when a compiled library is found
+ * next to it, and keeps using the pure Python code otherwise. Build it with:
+ *
+ *     cc -O2 -shared -fPIC -o _palmdoc.so _palmdoc.c
+ *
+ * Both functions must produce exactly the same bytes as the Python code.
+ */
+
+#include <stdlib.h>
+
+#define MIN_MATCH 3
+#define MAX_MATCH 10
+#define OUTPUT_LIMIT 6000
+
+#define HASH_BITS 12
+#define KEY(d, p) (((long)(d)[p] << 16) | ((d)[(p) + 1] << 8) | (d)[(p) + 2])
+#define HASH(key) ((unsigned long)((key) * 2654435761UL) >> 20 & \
+                   ((1 << HASH_BITS) - 1))
+
+static void insert(const unsigned char *data, long size, long *head,
+                   long *chain, long start, long end)
+{
+    long position;
+    if (end > size - MIN_MATCH + 1) {
+        end = size - MIN_MATCH + 1;
+    }
+    for (position = start; position < end; position++) {
+        unsigned long hash = HASH(KEY(data, position));
+        chain[position] = head[hash];
+        head[hash] = position;
+    }
+}
+
+/*
+ * output must have room for size + size / 8 + 1 bytes. window_size and
+ * max_chain come from palm_compress.LEVELS; max_chain 0 means no limit.
+ * Returns the compressed length, or -1 when memory runs out.
+ */
+long palmdoc_compress(const unsigned char *data, long size,
+                      unsigned char *output, long window_size,
+                      long max_chain)
+{
+    long head[1 << HASH_BITS];
+    long *chain;
+    long position = 0, out = 0, run = -1, i;
+
+    chain = malloc(sizeof(long) * (size ? size : 1));
+    if (chain == NULL) {
+        return -1;
+    }
+    for (i = 0; i < (1 << HASH_BITS); i++) {
+        head[i] = -1;
+    }
+    while (position < size) {
+        unsigned char code = data[position];
+        long match_length = 0, distance = 0;
+        if (position + MIN_MATCH <= size) {
+            long key = KEY(data, position);
+            unsigned long hash = HASH(key);
+            long candidate = head[hash];
+            long limit = size - position < MAX_MATCH ? size - position
+                                                     : MAX_MATCH;
+            long tries = max_chain ? max_chain : size;
+            chain[position] = candidate;
+            head[hash] = position;
+            while (candidate >= 0 && position - candidate <= window_size) {
+                /* the hash table is smaller than the key space */
+                if (KEY(data, candidate) == key) {
+                    long length = MIN_MATCH;
+                    while (length < limit &&
+                           data[candidate + length] == data[position + length]) {
+                        length++;
+                    }
+                    if (length > match_length) {
+                        match_length = length;
+                        distance = position - candidate;
+                        if (length == limit) {
+                            break;
+                        }
+                    }
+                    if (--tries == 0) {
+                        break;
+                    }
+                }
+                candidate = chain[candidate];
+            }
+        }
+        if (match_length) {
+            long value = 0x8000 | (distance << 3) | (match_length - MIN_MATCH);
+            output[out++] = value >> 8;
+            output[out++] = value & 0xff;
+            run = -1;
+            insert(data, size, head, chain, position + 1,
+                   position + match_length);
+            position += match_length;
+        } else if (code == 32 && position + 1 < size &&
+                   data[position + 1] >= 0x40 && data[position + 1] < 0x80) {
+            output[out++] = data[position + 1] ^ 0x80;
+            run = -1;
+            insert(data, size, head, chain, position + 1, position + 2);
+            position += 2;
+        } else if (run < 0 && (code == 0 || (code >= 0x09 && code < 0x80))) {
+            output[out++] = code;
+            position++;
+        } else {
+            if (run < 0) {
+                run = out;
+                output[out++] = 0;
+            }
+            output[run]++;
+            output[out++] = code;
+            position++;
+            if (output[run] == 8)
+                run = -1;
+        }
+    }
+    free(chain);
+    return out;
+}
+
+/*
+ * output must have room for OUTPUT_LIMIT + 2 * size bytes.
+ * Returns the decompressed length, or -1 for input that refers outside of
+ * itself. The caller lets the Python code report those.
+ */
+long palmdoc_decompress(const unsigned char *data, long size,
+                        unsigned char *output)
+{
+    long i = 0, j = 0, n;
+    while (i < size) {
+        unsigned int c = data[i++];
+        if (c >= 0xc0) {
+            output[j++] = 32;
+            output[j++] = c & 0x7f;
+        } else if (c >= 0x80) {
+            long wcopy, wlen;
+            if (i >= size) {
+                return -1;
+            }
+            c = (c << 8) | data[i++];
+            wcopy = j - ((c >> 3) & 0x07ff);
+            wlen = (c & 7) + 3;
+            if (wlen > OUTPUT_LIMIT - j) {
+                wlen = OUTPUT_LIMIT - j;
+            }
+            if (wcopy < 0 || wcopy >= j) {
+                return -1;
+            }
+            for (n = 0; n < wlen; n++) {
+                output[j++] = output[wcopy++];
+            }
+        } else if (c >= 0x09 || c == 0) {
+            output[j++] = c;
+        } else {
+            long count = c;
+            if (count > OUTPUT_LIMIT - j) {
+                count = OUTPUT_LIMIT - j;
+            }
+            if (count > 0 && i + count > size) {
+                return -1;
+            }
+            for (n = 0; n < count; n++) {
+                output[j++] = data[i++];
+            }
+        }
+    }
+    return j;
+}
@@ -0,0 +1,35 @@
+# encoding: utf-8
+
+import os
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def write_atomically(path, write, fsync=False):
+    """Call write(file) with a temporary file next to path, then rename it
+    to path. Readers never see a half-written file. With fsync the data is
+    on disk before the rename.
+    """
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    flags = os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    file = os.fdopen(os.open(temp_path, flags, 0666), "w+b", BUFFER_SIZE)
+    try:
+        write(file)
+        file.flush()
+        if fsync:
+            os.fsync(file.fileno())
+    except:
+        file.close()
+        os.remove(temp_path)
+        raise
+    file.close()
+    if os.name == "nt" and os.path.exists(path):
+        # rename() doesn't replace files on Windows
+        os.remove(path)
+    os.rename(temp_path, path)
+    if fsync and os.name == "posix":
+        folder = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(folder)
+        finally:
+            os.close(folder)
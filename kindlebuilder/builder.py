@@ -2,6 +2,8 @@
 
 import os
 import codecs
+import multiprocessing
+from hashlib import md5
 
 from docutils import nodes
 from docutils.io import DocTreeInput, StringOutput
@@ -10,18 +12,34 @@ from docutils.frontend import OptionParser
 import sphinx.builders
 import sphinx.theming
 
+from sphinx import addnodes
+
 from sphinx.highlighting import PygmentsBridge
 from sphinx.locale import admonitionlabels, versionlabels, _
 from sphinx.util.console import bold, darkgreen, brown
 from sphinx.writers.html import HTMLTranslator
 
-from sphinx.util.nodes import inline_all_toctrees
 from sphinx.util.osutil import SEP, os_path, relative_uri, ensuredir, \
      movefile, ustrftime, copyfile
 from sphinx import __version__
 
 import kindlewriter
 import mobi_generator
+from fragment_cache import FragmentCache
+from doctree_prefetch import DoctreePrefetcher
+
+
+BUILDINFO = '.kindle-buildinfo'
+
+# (builder, doctree, jobs, exit_states) for the processes forked by translate_fragments()
+_fragment_jobs = None
+
+
+def _translate_fragment(index):
+    builder, doctree, jobs, exit_states = _fragment_jobs
+    node, state = jobs[index]
+    translator = kindlewriter.KindleHTMLTranslator(builder, doctree)
+    return translator.translate_fragment(node, state, exit_states)
 
 
 class KindleBuilder(sphinx.builders.Builder):
@@ -34,37 +52,222 @@ class KindleBuilder(sphinx.builders.Builder):
 
     def init(self):
         self.init_highlighter()
-        self.output = None
+        self.output_filename = None
+        # anchors that internal references point to and that exist in the
+        # book; the writer turns links to those into filepos links
+        self.link_targets = set()
      
     def init_highlighter(self):
         self.highlighter = PygmentsBridge('html', 'sphinx',
                                           self.config.trim_doctest_flags)
     
+    def get_outfilename(self):
+        return os.path.join(self.outdir,
+                            self.config.kindlebuilder_basename + '.azw')
+
+    def calc_build_hashes(self):
+        cfgdict = dict((name, self.config[name])
+                       for (name, desc) in self.config.values.iteritems()
+                       if desc[1] == 'html' or
+                          name.startswith('kindlebuilder_'))
+        self.config_hash = md5(unicode(cfgdict).encode('utf-8')).hexdigest()
+        self.tags_hash = md5(unicode(sorted(self.tags)).encode('utf-8')) \
+                         .hexdigest()
+
     def get_outdated_docs(self):
-        return 'all documents'
+        # same checks as the standalone HTML builder, against the one .azw
+        self.calc_build_hashes()
+        old_config_hash = old_tags_hash = ''
+        try:
+            fp = open(os.path.join(self.outdir, BUILDINFO))
+            try:
+                version = fp.readline()
+                if version.rstrip() != '# Sphinx build info version 1':
+                    raise ValueError
+                fp.readline()  # skip commentary
+                cfg, old_config_hash = fp.readline().strip().split(': ')
+                if cfg != 'config':
+                    raise ValueError
+                tag, old_tags_hash = fp.readline().strip().split(': ')
+                if tag != 'tags':
+                    raise ValueError
+            finally:
+                fp.close()
+        except ValueError:
+            self.warn('unsupported build info format in %r, building all' %
+                      os.path.join(self.outdir, BUILDINFO))
+        except (IOError, OSError):
+            pass
+        if old_config_hash != self.config_hash or \
+               old_tags_hash != self.tags_hash:
+            for docname in self.env.found_docs:
+                yield docname
+            return
+
+        try:
+            targetmtime = os.path.getmtime(self.get_outfilename())
+        except EnvironmentError:
+            targetmtime = 0
+        try:
+            # the cover is part of the book too
+            extramtime = os.path.getmtime(
+                self.config.kindlebuilder_cover_image or '')
+        except EnvironmentError:
+            extramtime = 0
+        for docname in self.env.found_docs:
+            if docname not in self.env.all_docs:
+                yield docname
+                continue
+            try:
+                srcmtime = max(os.path.getmtime(self.env.doc2path(docname)),
+                               extramtime)
+                if srcmtime > targetmtime:
+                    yield docname
+            except EnvironmentError:
+                # source doesn't exist anymore
+                pass
+
+    def write_buildinfo(self):
+        fp = open(os.path.join(self.outdir, BUILDINFO), 'w')
+        try:
+            fp.write('# Sphinx build info version 1\n'
+                     '# This file hashes the configuration used when building'
+                     ' the .azw file. When it is not found, a full rebuild'
+                     ' will be done.\n'
+                     'config: %s\ntags: %s\n' %
+                     (self.config_hash, self.tags_hash))
+        finally:
+            fp.close()
 
     def assemble_doctree(self):
         master = self.config.master_doc
-        tree = self.env.get_doctree(master)
-        tree = inline_all_toctrees(self, set(), master, tree, darkgreen)
+        prefetcher = None
+        load = self.env.get_doctree
+        if self.config.kindlebuilder_doctree_prefetch:
+            prefetcher = DoctreePrefetcher(
+                self.env, self.toctree_order(master),
+                max_loaded=self.config.kindlebuilder_doctree_prefetch)
+            load = prefetcher.get
+        self.unresolved_count = 0
+        self.references = []
+        self.pending_xrefs = []
+        self.book_ids = set(['document-' + master])
+        try:
+            tree = self.env.get_doctree(master)
+            tree = self.inline_all_toctrees(set(), master, tree, darkgreen,
+                                            load)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
         tree['docname'] = master
-        self.env.resolve_references(tree, master, self)
+        if self.unresolved_count:
+            self.env.resolve_references(tree, master, self)
+        else:
+            # no pending_xref or only node anywhere: skip the two traversals
+            # and just send the event resolve_references() ends with
+            self.app.emit('doctree-resolved', tree, master)
+        # Sphinx versions without _listeners keep handlers elsewhere; walk
+        # the tree again there too
+        listeners = getattr(self.app, '_listeners', None)
+        if listeners is None or listeners.get('doctree-resolved'):
+            # handlers of the event may have added references and ids
+            # anywhere, so look at the whole tree again
+            self.references = []
+            for node in tree.traverse(nodes.Element):
+                if isinstance(node, nodes.reference):
+                    self.references.append(node)
+                self.book_ids.update(node['ids'])
+        else:
+            for parent, index, pending in self.pending_xrefs:
+                # resolve_references() replaced each of them in place
+                if index < len(parent) and \
+                       isinstance(parent[index], nodes.reference):
+                    self.references.append(parent[index])
         self.fix_refuris(tree)
+        self.references = self.pending_xrefs = self.book_ids = None
+        return tree
+
+    def toctree_order(self, master):
+        """Return the docnames below master in the order
+        inline_all_toctrees() loads them.
+        """
+        includes = self.env.toctree_includes
+        order = []
+        seen = set([master])
+        stack = [iter(includes.get(master, ()))]
+        while stack:
+            for docname in stack[-1]:
+                docname = str(docname)
+                if docname not in seen:
+                    seen.add(docname)
+                    order.append(docname)
+                    stack.append(iter(includes.get(docname, ())))
+                    break
+            else:
+                stack.pop()
+        return order
+
+    def inline_all_toctrees(self, docnameset, docname, tree, colorfunc, load):
+        """Same as sphinx.util.nodes.inline_all_toctrees(), but doctrees
+        come from load() and aren't copied, since each one is freshly
+        loaded. Nodes left for resolve_references() are counted on the way.
+        """
+        toctrees = []
+        for node in tree.traverse():
+            if isinstance(node, addnodes.toctree):
+                toctrees.append(node)
+            elif isinstance(node, addnodes.pending_xref):
+                self.unresolved_count += 1
+                self.pending_xrefs.append(
+                    (node.parent, node.parent.index(node), node))
+            elif isinstance(node, addnodes.only):
+                self.unresolved_count += 1
+            elif isinstance(node, nodes.reference):
+                self.references.append(node)
+            if isinstance(node, nodes.Element):
+                self.book_ids.update(node['ids'])
+        for toctreenode in toctrees:
+            newnodes = []
+            includefiles = map(str, toctreenode['includefiles'])
+            for includefile in includefiles:
+                try:
+                    self.info(colorfunc(includefile) + " ", nonl=1)
+                    subtree = self.inline_all_toctrees(docnameset,
+                        includefile, load(includefile), colorfunc, load)
+                    docnameset.add(includefile)
+                except Exception:
+                    self.warn('toctree contains ref to nonexisting '
+                              'file %r' % includefile,
+                              self.env.doc2path(docname))
+                else:
+                    self.book_ids.add('document-' + includefile)
+                    sof = addnodes.start_of_file(docname=includefile)
+                    sof.children = subtree.children
+                    newnodes.append(sof)
+            toctreenode.parent.replace(toctreenode, newnodes)
         return tree
 
     def fix_refuris(self, tree):
-        # fix refuris with double anchor
+        """Fix refuris with double anchor and collect the anchors of
+        internal references that are in the book. Works on the references recorded by
+        inline_all_toctrees() and assemble_doctree(), which only walk tree
+        again when doctree-resolved has handlers.
+        """
         fname = self.config.master_doc + self.out_suffix
-        for refnode in tree.traverse(nodes.reference):
-            if 'refuri' not in refnode:
-                continue
-            refuri = refnode['refuri']
-            hashindex = refuri.find('#')
-            if hashindex < 0:
-                continue
-            hashindex = refuri.find('#', hashindex+1)
-            if hashindex >= 0:
-                refnode['refuri'] = fname + refuri[hashindex:]
+        anchors = set()
+        for refnode in self.references:
+            if 'refuri' in refnode:
+                refuri = refnode['refuri']
+                hashindex = refuri.find('#')
+                if hashindex >= 0:
+                    hashindex = refuri.find('#', hashindex+1)
+                    if hashindex >= 0:
+                        refnode['refuri'] = fname + refuri[hashindex:]
+            anchor = kindlewriter.reference_anchor(
+                refnode, self.config.master_doc, self.out_suffix)
+            if anchor is not None:
+                anchors.add(anchor)
+        self.link_targets = anchors & self.book_ids
 
     def prepare_writing(self, docnames):
         from sphinx.search import IndexBuilder
@@ -73,6 +276,16 @@ class KindleBuilder(sphinx.builders.Builder):
             defaults=self.env.settings,
             components=(self.docwriter,)).get_default_values()
         self.docsettings.compact_lists = True
+        self.calc_build_hashes()
+        self.translate_workers = self.get_translate_workers()
+        if self.config.kindlebuilder_fragment_cache:
+            self.fragment_cache = FragmentCache(
+                os.path.join(self.doctreedir, 'kindle_fragments.pickle'))
+        elif self.translate_workers > 1:
+            # parallel translation hands fragments over through the cache
+            self.fragment_cache = FragmentCache(None)
+        else:
+            self.fragment_cache = None
         
         # determine the additional indices to include
         self.domain_indices = []
@@ -129,6 +342,52 @@ class KindleBuilder(sphinx.builders.Builder):
             builder = self.name,
         )
 
+    def get_translate_workers(self):
+        workers = self.config.kindlebuilder_translate_workers
+        if workers is None:
+            # follow sphinx-build -j where Sphinx has it
+            workers = getattr(self.app, 'parallel', 1) or 1
+        elif not workers:
+            workers = multiprocessing.cpu_count()
+        if os.name != 'posix':
+            # workers get the doctree by fork()
+            return 1
+        is_parallel_allowed = getattr(self.app, 'is_parallel_allowed', None)
+        if is_parallel_allowed is not None and \
+               not is_parallel_allowed('write'):
+            return 1
+        return workers
+
+    def translate_fragments(self, doctree):
+        """Translate the inlined documents that aren't cached in worker
+        processes. write_doc() then merges the fragments in toctree order.
+        """
+        global _fragment_jobs
+        translator = kindlewriter.KindleHTMLTranslator(self, doctree)
+        documents = kindlewriter.inlined_document_states(
+            doctree, translator.get_state())
+        exit_states = dict((node['docname'], exit_state)
+                           for node, state, exit_state in documents)
+        jobs = []
+        for node, state, exit_state in documents:
+            key = kindlewriter.fragment_key(node, state, self.config_hash,
+                                            exit_states)
+            if not self.fragment_cache.has(node['docname'], key):
+                jobs.append((node, state))
+        if len(jobs) < 2:
+            return 0
+        _fragment_jobs = (self, doctree, jobs, exit_states)
+        pool = multiprocessing.Pool(min(self.translate_workers, len(jobs)))
+        try:
+            fragments = pool.map(_translate_fragment, xrange(len(jobs)))
+        finally:
+            pool.close()
+            pool.join()
+            _fragment_jobs = None
+        for (node, state), fragment in zip(jobs, fragments):
+            self.fragment_cache.set(node['docname'], fragment)
+        return len(jobs)
+
     def write(self, *ignored):
         docnames = self.env.all_docs
 
@@ -158,8 +417,16 @@ class KindleBuilder(sphinx.builders.Builder):
         self.imgpath = relative_uri(self.get_target_uri(docname), '_images')
         self.post_process_images(doctree)
         self.dlpath = relative_uri(self.get_target_uri(docname), '_downloads')
+        translated = 0
+        if self.translate_workers > 1:
+            translated = self.translate_fragments(doctree)
         self.docwriter.write(doctree, destination)
         self.docwriter.assemble_parts()
+        if self.fragment_cache is not None:
+            self.fragment_cache.save()
+            self.info('(%d documents reused, %d translated in parallel) ' %
+                      (self.fragment_cache.hits - translated, translated),
+                      nonl=True)
         body = self.docwriter.parts['fragment']
         self.handle_page(docname, self.docwriter.parts, event_arg=doctree)
 
@@ -182,7 +449,7 @@ class KindleBuilder(sphinx.builders.Builder):
 
         self.app.emit('html-page-context', pagename, templatename,
                       ctx, event_arg)
-        self.output = part['whole_contents']
+        contents = part['whole_contents']
         # for debug
         def get_outfilename(pagename):
             return os.path.join(self.outdir, os_path(pagename) + self.out_suffix)
@@ -193,11 +460,14 @@ class KindleBuilder(sphinx.builders.Builder):
         try:
             f = open(outfilename, "wb")
             try:
-                f.write(self.output)
+                # streamed chunk by chunk; the generator reads it back
+                # one record at a time
+                contents.write_file(f)
             finally:
                 f.close()
         except (IOError, OSError), err:
             self.warn("error writing file %s: %s" % (outfilename, err))
+        self.output_filename = outfilename
 
     def finish(self):
         self.info(bold('writing additional files...'), nonl=1)
@@ -219,7 +489,6 @@ class KindleBuilder(sphinx.builders.Builder):
         #self.copy_image_files()
         #self.copy_download_files()
         #self.copy_static_files()
-        #self.write_buildinfo()
         
         if self.config.kindlebuilder_title:
             name = self.config.kindlebuilder_title
@@ -228,8 +497,25 @@ class KindleBuilder(sphinx.builders.Builder):
 
         generator = mobi_generator.MobiFileGenerator()
         generator.set_name(name)
-        generator.set_text(self.output)
+        generator.set_compress_workers(self.config.kindlebuilder_compress_workers)
+        generator.set_compression_level(
+            self.config.kindlebuilder_compression_level)
+        generator.set_verify_output(self.config.kindlebuilder_verify_output)
+        generator.set_output_mode(self.config.kindlebuilder_output_mode)
+        generator.set_fsync_output(self.config.kindlebuilder_fsync_output)
+        if self.config.kindlebuilder_save_layout_plan:
+            generator.set_layout_plan(
+                os.path.join(self.doctreedir, "kindle_layout.plan"))
+        if self.config.kindlebuilder_compress_cache_size:
+            generator.set_compress_cache(
+                os.path.join(self.doctreedir, "kindle_compress_cache"),
+                self.config.kindlebuilder_compress_cache_size)
+        generator.set_text_file(self.output_filename)
         print len(self.docwriter.images)
         generator.set_images(self.docwriter.images)
         generator.set_cover_image(self.config.kindlebuilder_cover_image)
         generator.generate(self.outdir, self.config.kindlebuilder_basename)
+
+        # -a and explicit file lists skip get_outdated_docs()
+        self.calc_build_hashes()
+        self.write_buildinfo()
@@ -0,0 +1,67 @@
+# encoding: utf-8
+
+import os
+import hashlib
+
+from atomic_file import write_atomically
+
+
+class CompressCache(object):
+    """On-disk cache of compressed text records.
+
+    Every entry is a file named after the SHA-1 of format_version, the
+    compression level and the raw record, so unchanged records are reused
+    between builds. When the directory grows over max_size bytes, the least
+    recently used entries are removed.
+
+    format_version must be raised whenever palm_compress writes different
+    output for the same record.
+    """
+    format_version = 2      # 2: type A runs are closed at 8 bytes
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, chunk, level):
+        digest = hashlib.sha1("%d\0%s" % (self.format_version, level))
+        digest.update("\0")
+        digest.update(chunk)
+        return os.path.join(self.directory, digest.hexdigest())
+
+    def get(self, chunk, level):
+        path = self._path(chunk, level)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            record = f.read()
+        finally:
+            f.close()
+        os.utime(path, None)    # mark as recently used
+        self.hits += 1
+        return record
+
+    def set(self, chunk, record, level):
+        write_atomically(self._path(chunk, level), lambda f: f.write(record))
+
+    def trim(self):
+        entries = []
+        total = 0
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
@@ -0,0 +1,44 @@
+# encoding: utf-8
+
+from multiprocessing.pool import ThreadPool
+
+
+class DoctreePrefetcher(object):
+    """Loads pickled doctrees from a build environment on a thread pool,
+    ahead of the order they will be asked for.
+
+    At most max_loaded doctrees are loaded or loading at a time. get() takes
+    one out and starts the next in order. A doctree that is asked for out of
+    order is loaded directly; it takes no slot, so nothing is dropped.
+    """
+    def __init__(self, env, docnames, workers=4, max_loaded=32):
+        self.env = env
+        self.order = list(docnames)
+        self.next = 0
+        self.max_loaded = max_loaded
+        self.loaded = {}
+        self.pool = ThreadPool(workers)
+        self._fill()
+
+    def _fill(self):
+        while len(self.loaded) < self.max_loaded and \
+                self.next < len(self.order):
+            docname = self.order[self.next]
+            self.next += 1
+            if docname not in self.loaded:
+                self.loaded[docname] = self.pool.apply_async(
+                    self.env.get_doctree, (docname,))
+
+    def get(self, docname):
+        result = self.loaded.pop(docname, None)
+        if result is not None:
+            doctree = result.get()
+        else:
+            doctree = self.env.get_doctree(docname)
+        self._fill()
+        return doctree
+
+    def close(self):
+        self.loaded.clear()
+        self.pool.close()
+        self.pool.join()
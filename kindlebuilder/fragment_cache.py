@@ -0,0 +1,100 @@
+# encoding: utf-8
+
+import cPickle
+
+from atomic_file import write_atomically
+
+
+class TranslatedFragment(object):
+    """What the translation of one inlined document added to the book.
+
+    ops holds, in order, HTML strings and tuples:
+
+    * ("heading", level, title)
+    * ("image", uri, tag) -- tag has IMAGE_INDEX where the index goes
+    * ("anchors", ids) -- ids of a node that links may point to
+    * ("link", anchor, tag) -- start of an internal link, tag without
+      filepos
+    * ("document", docname, state) -- a document inlined here
+
+    key identifies the doctree and translator state it was made from.
+    """
+    IMAGE_INDEX = "\0recindex\0"
+
+    def __init__(self, key):
+        self.key = key
+        self.ops = []
+        self.exit_state = None
+        self._data = []
+
+    def add_data(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self._data.append(data)
+
+    def add(self, op):
+        self._flush()
+        self.ops.append(op)
+
+    def finish(self, exit_state):
+        self._flush()
+        self.exit_state = exit_state
+        del self._data
+
+    def _flush(self):
+        if self._data:
+            self.ops.append("".join(self._data))
+            del self._data[:]
+
+
+class FragmentCache(object):
+    """TranslatedFragments of the last build, one per docname, kept in a
+    pickle file. Only the fragments used by a build are saved again.
+    With path None the cache only lives in memory.
+    """
+    format_version = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.fragments = {}
+        self.used = {}
+        if path is None:
+            return
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return
+        try:
+            try:
+                version, fragments = cPickle.load(f)
+            except Exception:
+                # broken or from another version of the builder
+                return
+        finally:
+            f.close()
+        if version == self.format_version:
+            self.fragments = fragments
+
+    def get(self, docname, key):
+        fragment = self.used.get(docname) or self.fragments.get(docname)
+        if fragment is None or fragment.key != key:
+            self.misses += 1
+            return None
+        self.used[docname] = fragment
+        self.hits += 1
+        return fragment
+
+    def has(self, docname, key):
+        fragment = self.used.get(docname) or self.fragments.get(docname)
+        return fragment is not None and fragment.key == key
+
+    def set(self, docname, fragment):
+        self.used[docname] = fragment
+
+    def save(self):
+        if self.path is None:
+            return
+        write_atomically(self.path, lambda f: cPickle.dump(
+            (self.format_version, self.used), f, 2))
@@ -1,11 +1,108 @@
 import os
-from docutils import nodes
+from hashlib import md5
+from docutils import nodes, writers
 from docutils.writers.html4css1 import Writer
+from sphinx import addnodes
 from sphinx.writers.html import HTMLTranslator
 from lazyevaluatearray import LazyEvaluateArray
+from fragment_cache import TranslatedFragment
 from sphinx.locale import admonitionlabels, versionlabels, _
 
 
+def fragment_key(node, state, config_hash, exit_states):
+    """md5 of a document subtree, without the documents inlined into it,
+    and of the translator state and config it is translated with.
+    exit_states maps docnames to the state each inlined document leaves
+    behind, which the rest of the document is translated in.
+    """
+    digest = md5(repr(state))
+    digest.update(config_hash)
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if current is None:
+            digest.update(")")
+        elif isinstance(current, nodes.Text):
+            digest.update(unicode(current).encode("utf-8"))
+        elif isinstance(current, addnodes.start_of_file):
+            # the enclosing compound sets first/last classes on these
+            digest.update("(start_of_file %s %r" % (
+                current['docname'], exit_states.get(current['docname'])))
+            if current is node:
+                stack.append(None)
+                stack.extend(reversed(current.children))
+        else:
+            digest.update("(" + current.__class__.__name__)
+            digest.update(repr(sorted(current.attributes.items())))
+            stack.append(None)
+            stack.extend(reversed(current.children))
+    return digest.hexdigest()
+
+
+def inlined_documents(node):
+    """Return the start_of_file nodes inlined into the document of node,
+    but not the ones inlined into those.
+    """
+    documents = []
+    stack = list(reversed(node.children))
+    while stack:
+        current = stack.pop()
+        if isinstance(current, addnodes.start_of_file):
+            documents.append(current)
+        elif isinstance(current, nodes.Element):
+            stack.extend(reversed(current.children))
+    return documents
+
+
+def reference_anchor(node, master_doc, suffix):
+    """Return the anchor a reference into the single HTML page points to,
+    or None for other references.
+    """
+    if 'refuri' not in node:
+        return node.get('refid')
+    refuri = node['refuri']
+    fname = master_doc + suffix
+    if refuri in ('', fname):
+        return 'document-' + master_doc
+    if refuri.startswith('#'):
+        return refuri[1:]
+    if refuri.startswith(fname + '#'):
+        return refuri[len(fname)+1:]
+    return None
+
+
+def inlined_document_states(doctree, state):
+    """Return (start_of_file node, translator state, exit state) for every
+    document inlined into doctree, in document order. state is the state
+    the translation of doctree starts in. The exit state is the state a
+    document leaves behind, after the documents inlined into it.
+    """
+    result = []
+    section_level, highlightlang, threshold = state
+    # inline_all_toctrees() doesn't fix the parent of inlined nodes, so
+    # the section level is counted on the way down
+    stack = [(child, section_level) for child in reversed(doctree.children)]
+    while stack:
+        node, level = stack.pop()
+        if node is None:
+            # end of the document at index level of result
+            document, entry = result[level]
+            result[level] = (document, entry,
+                             (entry[0], highlightlang, threshold))
+            continue
+        if isinstance(node, addnodes.highlightlang):
+            highlightlang = node['lang']
+            threshold = node['linenothreshold']
+        elif isinstance(node, addnodes.start_of_file):
+            stack.append((None, len(result)))
+            result.append((node, (level, highlightlang, threshold)))
+        if isinstance(node, nodes.section):
+            level += 1
+        if isinstance(node, nodes.Element):
+            stack.extend((child, level) for child in reversed(node.children))
+    return result
+
+
 class KindleHTMLWriter(Writer):
     supported = ('html',)
 
@@ -33,10 +130,20 @@ class KindleHTMLWriter(Writer):
             setattr(self, attr, getattr(visitor, attr, None))
         #self.visitor.whole_contents.dump()
 
+    def assemble_parts(self):
+        writers.Writer.assemble_parts(self)
+        for part in self.visitor_attributes:
+            if part in ('whole_contents', 'body', 'images'):
+                # whole_contents and body stay LazyEvaluateArrays, so that
+                # the builder can write them out without joining the book
+                self.parts[part] = getattr(self, part)
+            else:
+                self.parts[part] = ''.join(getattr(self, part))
+
 
 class KindleReferenceWriter(LazyEvaluateArray):
     def add_reference(self, title, type):
-        label = "kindle special reference: %s" % type
+        label = self.new_label(("kindle special reference", type))
         self.append('<reference title="%s" type="%s" filepos=' % (title, type))
         self.offset(label, 10, "%010d")
         self.append(' />')
@@ -54,7 +161,7 @@ class KindleHeadingWriter(LazyEvaluateArray):
         index = self.last_index
         self.last_index += 1
         
-        label = "kindle heading: %s-%s" % (index, level)
+        label = self.new_label(("kindle heading", index, level))
         print label
         
         if level in (1, 2):
@@ -95,6 +202,19 @@ class KindleHeadingWriter(LazyEvaluateArray):
 
 
 
+class KindleBodyWriter(LazyEvaluateArray):
+    """Body of the book. While fragment is set, everything appended is
+    recorded in it too.
+    """
+    def init(self):
+        self.fragment = None
+
+    def append(self, data):
+        if self.fragment is not None:
+            self.fragment.add_data(data)
+        LazyEvaluateArray.append(self, data)
+
+
 class KindleHTMLTranslator(HTMLTranslator):
     def __init__(self, builder, document):
         HTMLTranslator.__init__(self, builder, document)
@@ -126,6 +246,16 @@ class KindleHTMLTranslator(HTMLTranslator):
         
         self.kindle_title = None
         self.images = []
+        self.fragment_stack = []
+        # (slot, anchor, tag) of every link, filled by resolve_links()
+        self.links = []
+        self.placed_anchors = set()
+        # id -> LabelHandle, shared by the body and the link slots
+        self.anchor_labels = {}
+        # docname -> state each inlined document leaves behind
+        self.exit_states = {}
+        # only translate the outermost document, see translate_fragment()
+        self.isolated = False
     
     def initial_contents(self):
         self.whole_contents.append("<html><head><guide>")
@@ -137,37 +267,205 @@ class KindleHTMLTranslator(HTMLTranslator):
         
         self.whole_contents.append("<p><center><h1><big>* * *</big></h1></center></p>  <mbp:pagebreak/>")
         reference.add_reference("Start", "start")
-        body = self.whole_contents.sub_array()
+        body = self.whole_contents.sub_array(KindleBodyWriter)
         headings.parent = body
         self.whole_contents.append("</body></html>")
         return body, reference, headings
 
     def astext(self):
-        self.fragment.extend(self.body.as_list())
-        return "".join(self.whole_contents.as_list())
+        # the whole book is written from whole_contents by the builder;
+        # fragment stays empty, so nothing is joined here
+        return "".join(self.fragment)
 
     def visit_document(self, node):
         self.kindle_title = node.get('title', '')
+        self.exit_states = dict(
+            (document['docname'], exit_state) for document, state, exit_state
+            in inlined_document_states(node, self.get_state()))
+        self.add_anchors(['document-' + node.get('docname', '')])
         return
 
     def depart_document(self, node):
         assert not self.context, 'len(context) = %s' % len(self.context)
+        self.resolve_links()
         self.whole_contents.lock()
-        self.fragment.extend(self.body.as_list())
 
     def visit_section(self, node):
         self.section_level += 1
+        self.add_anchors(node['ids'])
         self.body.append('<p height="0" width="0em">')
 
     def depart_section(self, node):
         self.section_level -= 1
         self.body.append('</p>')
 
+    def get_state(self):
+        # translator state that carries over into an inlined document
+        return (self.section_level, self.highlightlang,
+                self.highlightlinenothreshold)
+
+    def set_state(self, state):
+        (self.section_level, self.highlightlang,
+         self.highlightlinenothreshold) = state
+
+    def add_heading(self, level, title):
+        fragment = self.body.fragment
+        if fragment is not None:
+            fragment.add(("heading", level, title))
+        # what the heading writer adds to the body is redone on replay
+        self.body.fragment = None
+        try:
+            self.headings.visit(level, title)
+        finally:
+            self.body.fragment = fragment
+
+    def add_image(self, uri, tag):
+        self.images.append(uri)
+        fragment = self.body.fragment
+        if fragment is not None:
+            fragment.add(("image", uri, tag))
+        self.body.fragment = None
+        try:
+            self.body.append(tag.replace(TranslatedFragment.IMAGE_INDEX,
+                                         str(len(self.images))))
+        finally:
+            self.body.fragment = fragment
+
+    def add_anchors(self, ids):
+        """Put a label at the anchors in ids that links point to."""
+        if not ids:
+            return
+        if self.body.fragment is not None:
+            self.body.fragment.add(("anchors", list(ids)))
+        for id in ids:
+            if id in self.builder.link_targets:
+                self.body.label(self.anchor_label(id))
+                self.placed_anchors.add(id)
+
+    def anchor_label(self, id):
+        """Return the LabelHandle of the anchor id."""
+        label = self.anchor_labels.get(id)
+        if label is None:
+            label = self.anchor_labels[id] = self.body.new_label(
+                ("kindle anchor", id))
+        return label
+
+    def add_link(self, anchor, tag):
+        """Start a link to anchor. When the anchor may be in the book, an
+        empty slot is left for resolve_links(), else tag is added.
+        """
+        fragment = self.body.fragment
+        if fragment is not None:
+            fragment.add(("link", anchor, tag))
+        self.body.fragment = None
+        try:
+            if anchor in self.builder.link_targets:
+                self.links.append((self.body.sub_array(), anchor, tag))
+            else:
+                self.body.append(tag)
+        finally:
+            self.body.fragment = fragment
+
+    def resolve_links(self):
+        """Fill the slots of add_link(): a filepos link when a label was
+        put at the anchor, else the tag. Ids of nodes that are not
+        translated, like raw nodes or only nodes removed for this builder,
+        get no label.
+        """
+        for slot, anchor, tag in self.links:
+            if anchor in self.placed_anchors:
+                slot.append('<a filepos=')
+                slot.offset(self.anchor_label(anchor), 10, "%010d")
+                slot.append(' >')
+            else:
+                slot.append(tag)
+        del self.links[:]
+
+    def starttag(self, node, tagname, suffix='\n', empty=0, **attributes):
+        self.add_anchors(node.get('ids'))
+        return HTMLTranslator.starttag(self, node, tagname, suffix, empty,
+                                       **attributes)
+
+    def visit_reference(self, node):
+        anchor = reference_anchor(node, self.builder.config.master_doc,
+                                  self.builder.out_suffix)
+        if anchor is None:
+            return HTMLTranslator.visit_reference(self, node)
+        atts = {'class': 'reference internal'}
+        if 'refuri' in node:
+            atts['href'] = node['refuri']
+        else:
+            atts['href'] = '#' + node['refid']
+        if not isinstance(node.parent, nodes.TextElement):
+            atts['class'] += ' image-reference'
+        if 'reftitle' in node:
+            atts['title'] = node['reftitle']
+        self.add_link(anchor, self.starttag(node, 'a', '', **atts))
+        if node.hasattr('secnumber'):
+            self.body.append(('%s' + self.secnumber_suffix) %
+                             '.'.join(map(str, node['secnumber'])))
+
+    def replay(self, fragment, node):
+        """Add a cached fragment of node's document to the book."""
+        documents = dict((document['docname'], document)
+                         for document in inlined_documents(node))
+        for op in fragment.ops:
+            if isinstance(op, str):
+                self.body.append(op)
+            elif op[0] == "heading":
+                self.add_heading(op[1], op[2])
+            elif op[0] == "image":
+                self.add_image(op[1], op[2])
+            elif op[0] == "anchors":
+                self.add_anchors(op[1])
+            elif op[0] == "link":
+                self.add_link(op[1], op[2])
+            else:
+                self.set_state(op[2])
+                documents[op[1]].walkabout(self)
+        self.set_state(fragment.exit_state)
+
+    def translate_fragment(self, node, state, exit_states):
+        """Translate the document of the start_of_file node alone and
+        return its TranslatedFragment. Documents inlined into it are only
+        recorded, and the rest is translated in the state they leave behind,
+        taken from exit_states.
+        """
+        self.isolated = True
+        self.exit_states = exit_states
+        self.set_state(state)
+        node.walkabout(self)
+        return self.builder.fragment_cache.used[node['docname']]
+
     def visit_start_of_file(self, node):
         # only occurs in the single-file builder
-        pass
+        docname = node['docname']
+        if self.body.fragment is not None:
+            self.body.fragment.add(("document", docname, self.get_state()))
+            if self.isolated:
+                self.set_state(self.exit_states[docname])
+                raise nodes.SkipNode
+        self.fragment_stack.append(self.body.fragment)
+        self.body.fragment = None
+        cache = self.builder.fragment_cache
+        if cache is not None:
+            key = fragment_key(node, self.get_state(),
+                               self.builder.config_hash, self.exit_states)
+            fragment = cache.get(docname, key)
+            if fragment is not None:
+                self.replay(fragment, node)
+                self.body.fragment = self.fragment_stack.pop()
+                raise nodes.SkipNode
+            self.body.fragment = TranslatedFragment(key)
+        self.add_anchors(['document-' + docname])
+
     def depart_start_of_file(self, node):
         self.body.append("<mbp:pagebreak/>")
+        fragment = self.body.fragment
+        if fragment is not None:
+            fragment.finish(self.get_state())
+            self.builder.fragment_cache.set(node['docname'], fragment)
+        self.body.fragment = self.fragment_stack.pop()
 
     # not support in Kindle
     
@@ -293,12 +591,11 @@ class KindleHTMLTranslator(HTMLTranslator):
         filesize = os.path.getsize(uri)
         if filesize > 64000:
             raise NotImplementedError("should implement this feature")
-        imagesrc = open(uri, "rb").read()
-        self.images.append(imagesrc)
-        index = len(self.images)
+        index = TranslatedFragment.IMAGE_INDEX
         if 'align' in node:
             self.body.append('<center>')
-        self.body.append(self.emptytag(node, 'img', '', recindex=index, hirecindex=index))
+        self.add_image(uri, self.emptytag(node, 'img', '', recindex=index,
+                                          hirecindex=index))
         if 'align' in node:
             self.body.append('</center>')
     def depart_image(self, node):
@@ -334,7 +631,7 @@ class KindleHTMLTranslator(HTMLTranslator):
                 h_level = self.section_level - 1
             else:
                 h_level = self.section_level
-            self.headings.visit(h_level, node.astext())
+            self.add_heading(h_level, node.astext())
             print "visit_title(%d): " % h_level, node.astext()
 
     def depart_title(self, node):
@@ -1,8 +1,34 @@
 # encoding: utf-8
 
+import os
+import mmap
 import time
 import struct
 import uuid
+import cPickle
+import threading
+from multiprocessing.pool import ThreadPool
+
+# open file sources are shared by many FileChunks, so seek() + read() on
+# them must not be interleaved by write_mmap() threads
+_source_lock = threading.Lock()
+
+class LabelHandle(object):
+    """A position label. It is resolved by an index into the positions list
+    shared by the whole array tree, so two handles never collide even when
+    they have the same name.
+    """
+    __slots__ = ("index", "name")
+
+    def __init__(self, index, name=None):
+        self.index = index
+        self.name = name
+
+    def __str__(self):
+        if isinstance(self.name, tuple):
+            return "/".join(str(part) for part in self.name)
+        return str(self.name)
+
 
 class VirtualChunk(object):
     def __init__(self, length):
@@ -18,6 +44,12 @@ class VirtualChunk(object):
     
     def __len__(self):
         return self.length
+
+    def layout(self, offset, lazyarray):
+        return offset + self.length
+
+    def shift(self, delta, lazyarray):
+        pass
         
     def write(self, writer, lazyarray):
         raise NotImplemented()
@@ -30,8 +62,8 @@ class LengthFlag(VirtualChunk):
         super(LengthFlag, self).__init__(length)
     
     def write(self, writer, lazyarray):
-        end = lazyarray.find_position(self.end_key)
-        begin = lazyarray.find_position(self.begin_key)
+        end = lazyarray._label_positions[self.end_key.index]
+        begin = lazyarray._label_positions[self.begin_key.index]
         if end is None and begin is None:
             raise ValueError("position key: '%s' and '%s' is not defined" % (
                 self.begin_key, self.end_key))
@@ -54,7 +86,7 @@ class OffsetFlag(VirtualChunk):
         super(OffsetFlag, self).__init__(length)
     
     def write(self, writer, lazyarray):
-        position = lazyarray.find_position(self.key)
+        position = lazyarray._label_positions[self.key.index]
         if position is None:
             raise ValueError("position key: '%s' is not defined" % (self.key))
         if self.format:
@@ -85,14 +117,98 @@ class Variable(VirtualChunk):
             if self.length <= len(value):
                 writer.write(value[:self.length])
             else:
-                writer.write(value)
-                for i in range(self.length - len(value)):  # padding
-                    writer.write('\0')
+                writer.write(value + '\0' * (self.length - len(value)))
 
     def dump(self):
         return "Variable: %s" % self.key
 
 
+class HeaderLayout(object):
+    """Fixed-layout header compiled into one struct.Struct.
+
+    fields is a list of (kind, format, value[, default]) tuples:
+
+    * ("data", format, constant)
+    * ("variable", format, key[, default]) -- like variable()
+    * ("length", format, (start_key, end_key)) -- like length()
+    * ("offset", format, key) -- like offset()
+    * ("unique", format) -- unique_number() picked for each header()
+
+    All fields are big endian and packed without padding.
+    """
+    kinds = ("data", "variable", "length", "offset", "unique")
+
+    def __init__(self, fields):
+        self.fields = list(fields)
+        for field in self.fields:
+            if field[0] not in self.kinds:
+                raise ValueError("unknown header field kind: '%s'" % field[0])
+        self.struct = struct.Struct(
+            "!" + "".join(field[1] for field in self.fields))
+        self.size = self.struct.size
+        # fields that are only known at write time
+        self.dynamic = [(index, field[0])
+                        for index, field in enumerate(self.fields)
+                        if field[0] in ("variable", "length", "offset")]
+
+    def __reduce__(self):
+        # struct.Struct can't be pickled, so layout plans rebuild it
+        return (HeaderLayout, (self.fields,))
+
+
+class HeaderChunk(VirtualChunk):
+    """One header of a HeaderLayout. Constant fields are kept in values,
+    dynamic fields hold a variable key or label handles until write().
+    """
+    def __init__(self, header_layout, values):
+        self.header_layout = header_layout
+        self.values = values
+        super(HeaderChunk, self).__init__(header_layout.size)
+
+    def resolve(self, lazyarray, kinds=("variable", "length", "offset")):
+        values = list(self.values)
+        for index, kind in self.header_layout.dynamic:
+            if kind not in kinds:
+                continue
+            key = values[index]
+            if kind == "variable":
+                value = lazyarray.find_variable(key)
+                if value is None:
+                    raise ValueError("variable key: '%s' is not defined" % (
+                        key))
+            elif kind == "offset":
+                value = lazyarray._label_positions[key.index]
+                if value is None:
+                    raise ValueError("position key: '%s' is not defined" % (
+                        key))
+            else:
+                positions = lazyarray._label_positions
+                begin, end = positions[key[0].index], positions[key[1].index]
+                if begin is None or end is None:
+                    raise ValueError(
+                        "position key: '%s' or '%s' is not defined" % key)
+                value = end - begin
+            values[index] = value
+        return values
+
+    def frozen(self, lazyarray):
+        """Return a copy with offsets and lengths replaced by numbers, for
+        layout plans. Variables stay open.
+        """
+        values = self.resolve(lazyarray, ("length", "offset"))
+        fields = [field if field[0] not in ("length", "offset")
+                  else ("data", field[1], None)
+                  for field in self.header_layout.fields]
+        return HeaderChunk(HeaderLayout(fields), values)
+
+    def write(self, writer, lazyarray):
+        writer.write(self.header_layout.struct.pack(
+            *self.resolve(lazyarray)))
+
+    def dump(self):
+        return "Header: %d fields" % len(self.values)
+
+
 class Label(object):
     def __init__(self, key):
         self.key = key
@@ -104,38 +220,132 @@ class Label(object):
     def __len__(self):
         return 0
 
+    def layout(self, offset, lazyarray):
+        lazyarray._label_positions[self.key.index] = offset
+        return offset
+
+    def shift(self, delta, lazyarray):
+        lazyarray._label_positions[self.key.index] += delta
+
     def dump(self):
         return "Label: %s" % self.key
 
 
 class DataChunk(object):
+    """A run of static bytes. Consecutive data() and append() calls extend
+    the same chunk, so the layout only visits one object per run.
+    """
     def __init__(self, data):
+        self.parts = []
+        self.length = 0
+        self.extend(data)
+
+    def extend(self, data):
         if isinstance(data, unicode):
-            self.data = data.encode("utf-8")
-        else:
-            self.data = data
+            data = data.encode("utf-8")
+        self.parts.append(data)
+        self.length += len(data)
+
+    @property
+    def data(self):
+        return "".join(self.parts)
     
     def write(self, writer, lazyarray):
         writer.write(self.data)
     
     def __len__(self):
-        return len(self.data)
+        return self.length
+
+    def layout(self, offset, lazyarray):
+        return offset + self.length
+
+    def shift(self, delta, lazyarray):
+        pass
 
     def dump(self):
-        if len(self.data) < 30:
-            return self.data
-        return self.data[:29]
+        return self.parts[0][:29]
+
+
+class FileChunk(object):
+    """length bytes of a file from offset, copied block by block on write().
+
+    source is a path, opened only while writing, or an open file object.
+    """
+    block_size = 64 * 1024
+
+    def __init__(self, source, offset=0, length=None):
+        self.source = source
+        self.offset = offset
+        if length is None:
+            if isinstance(source, basestring):
+                length = os.path.getsize(source) - offset
+            else:
+                length = os.fstat(source.fileno()).st_size - offset
+        self.length = length
+
+    def write(self, writer, lazyarray):
+        if isinstance(self.source, basestring):
+            file = open(self.source, "rb")
+            try:
+                self._copy(file, writer)
+            finally:
+                file.close()
+        else:
+            self._copy(self.source, writer, _source_lock)
+
+    def _copy(self, file, writer, lock=None):
+        # with a lock, only seek() + read() of each block is serialized and
+        # the block is written outside of it
+        position = self.offset
+        rest = self.length
+        while rest > 0:
+            if lock is not None:
+                lock.acquire()
+            try:
+                file.seek(position)
+                block = file.read(min(rest, self.block_size))
+            finally:
+                if lock is not None:
+                    lock.release()
+            if not block:
+                raise IOError("%s is shorter than expected" % self.source)
+            writer.write(block)
+            position += len(block)
+            rest -= len(block)
+
+    def __len__(self):
+        return self.length
+
+    def layout(self, offset, lazyarray):
+        return offset + self.length
+
+    def shift(self, delta, lazyarray):
+        pass
+
+    def dump(self):
+        return "File: %s (%d bytes)" % (self.source, self.length)
+
+
+# events of LazyEvaluateArray._traverse()
+_ENTER, _LEAVE, _CHUNK = range(3)
 
 
 class LazyEvaluateArray(object):
-    def __init__(self, parent = None, args=[]):
+    def __init__(self, parent = None, args=[], lock=None):
         self._chunks = []
+        self._owner = None      # array that holds this one, set by layout
+        self._offset = 0        # start and size from the last layout
+        self._size = 0
+        self._flat = None       # leaf chunks of a locked tree, in order
+        self._named_labels = {}  # label keys of this array, see label_handle()
         if parent:
-            self._positions = parent._positions
+            self._label_positions = parent._label_positions
             self._variables = parent._variables
-            self._lock = parent._lock
+            if lock is None:
+                lock = parent._lock
+            self._lock = lock
         else:
-            self._positions = {}
+            self._label_positions = []
             self._variables = {}
             self._lock = []
         self.parent = parent
@@ -149,8 +359,27 @@ class LazyEvaluateArray(object):
             raise RuntimeError(("can't modify array any more. "
                                 "this array is locked"))
 
+    def new_label(self, name=None):
+        """Return a new LabelHandle. name is only used in messages."""
+        handle = LabelHandle(len(self._label_positions), name)
+        self._label_positions.append(None)
+        return handle
+
+    def label_handle(self, key):
+        """Return key itself for a LabelHandle. Any other key is mapped to
+        one handle per array, so sub-arrays can use the same keys without
+        colliding. Labels used from another array need a LabelHandle from
+        new_label().
+        """
+        if isinstance(key, LabelHandle):
+            return key
+        handle = self._named_labels.get(key)
+        if handle is None:
+            handle = self._named_labels[key] = self.new_label(key)
+        return handle
+
     def find_position(self, key):
-        return self._positions.get(key)
+        return self._label_positions[self.label_handle(key).index]
         
     def find_variable(self, key):
         return self._variables.get(key)
@@ -163,11 +392,13 @@ class LazyEvaluateArray(object):
     
     def length(self, start_key, end_key, length):
         self.lock_check() 
-        self._chunks.append(LengthFlag(length, start_key, end_key))
+        self._chunks.append(LengthFlag(length, self.label_handle(start_key),
+                                       self.label_handle(end_key)))
     
     def offset(self, key, length, format=None):
         self.lock_check()
-        self._chunks.append(OffsetFlag(length, key, format))
+        self._chunks.append(OffsetFlag(length, self.label_handle(key),
+                                       format))
 
     def variable(self, key, length=4, format=None, default=None):
         self.lock_check()
@@ -175,19 +406,52 @@ class LazyEvaluateArray(object):
         if default is not None:
             self.set_variable(key, default)
     
+    def header(self, header_layout):
+        """Append a header described by a HeaderLayout. It is packed with
+        a single struct call when written.
+        """
+        self.lock_check()
+        values = []
+        for field in header_layout.fields:
+            kind = field[0]
+            value = field[2] if len(field) > 2 else None
+            if kind == "variable":
+                if len(field) > 3 and field[3] is not None:
+                    self.set_variable(value, field[3])
+            elif kind == "offset":
+                value = self.label_handle(value)
+            elif kind == "length":
+                value = (self.label_handle(value[0]),
+                         self.label_handle(value[1]))
+            elif kind == "unique":
+                value = self.unique_number(struct.calcsize("!" + field[1]))
+            values.append(value)
+        self._chunks.append(HeaderChunk(header_layout, values))
+
     def label(self, key):
         self.lock_check()
-        self._chunks.append(Label(key))
+        self._chunks.append(Label(self.label_handle(key)))
     
     def append(self, data):
         self.lock_check()
-        self._chunks.append(DataChunk(data))
+        self._append_data(data)
     
     def data(self, data, *args):
         self.lock_check()
         if args:
             data = struct.pack(data, *args)
-        self._chunks.append(DataChunk(data))
+        self._append_data(data)
+
+    def _append_data(self, data):
+        chunks = self._chunks
+        if chunks and chunks[-1].__class__ is DataChunk:
+            chunks[-1].extend(data)
+        else:
+            chunks.append(DataChunk(data))
+
+    def file_data(self, source, offset=0, length=None):
+        self.lock_check()
+        self._chunks.append(FileChunk(source, offset, length))
     
     def sub_array(self, array_type=None, args=[]):
         self.lock_check()
@@ -196,29 +460,116 @@ class LazyEvaluateArray(object):
         new_array = array_type(self, args)
         self._chunks.append(new_array)
         return new_array
+
+    def detached_sub_array(self, array_type=None, args=[]):
+        """Create an array that shares label positions and variables with
+        this tree but isn't part of it. It stays writable after lock(), so it
+        can be filled and then put in place with replace_sub_array().
+        """
+        if array_type is None:
+            array_type = LazyEvaluateArray
+        return array_type(self, args, lock=[])
+
+    def replace_sub_array(self, old, new):
+        """Swap the sub-array old of this locked array for new.
+
+        Only new is laid out. Labels after it are moved by the size
+        difference, and the sizes of the enclosing arrays are adjusted.
+        Offsets pointing at labels that only existed in old aren't updated.
+        """
+        if not self._lock:
+            raise RuntimeError(("This array is not locked. "
+                                "Run lock() method first"))
+        index = self._chunks.index(old)
+        new._owner = self
+        new._calc_position(old._offset)
+        new._lock.append(True)
+        self._chunks[index] = new
+        array = self
+        while array is not None:
+            array._flat = None
+            array = array._owner
+        delta = new._size - old._size
+        array = self
+        while delta and array is not None:
+            chunks = array._chunks
+            for i in xrange(index + 1, len(chunks)):
+                chunks[i].shift(delta, array)
+            array._size += delta
+            if array._owner is not None:
+                index = array._owner._chunks.index(array)
+            array = array._owner
     
     def reserve(self, code, length):
         self.lock_check()
-        for i in range(length):
-            self.data("B", code)
+        self._append_data(chr(code) * length)
 
     def unique_number(self, length=4):
         return int(uuid.uuid4().int % 2 ** (length*8))
 
+    def _traverse(self):
+        """Walk the tree with an explicit stack instead of recursion.
+
+        Yields (_ENTER, array, owner) and (_LEAVE, array, owner) around
+        every array, and (_CHUNK, chunk, owner) for all other chunks.
+        """
+        yield _ENTER, self, None
+        stack = [(self, iter(self._chunks))]
+        while stack:
+            array, chunks = stack[-1]
+            for chunk in chunks:
+                if isinstance(chunk, LazyEvaluateArray):
+                    yield _ENTER, chunk, array
+                    stack.append((chunk, iter(chunk._chunks)))
+                    break
+                yield _CHUNK, chunk, array
+            else:
+                stack.pop()
+                if stack:
+                    yield _LEAVE, array, stack[-1][0]
+                else:
+                    yield _LEAVE, array, None
+
+    def _flattened(self):
+        """Return the chunks that produce output, in order (cached while
+        locked).
+        """
+        if self._flat is not None:
+            return self._flat
+        flat = [chunk for event, chunk, owner in self._traverse()
+                if event is _CHUNK and chunk.__class__ is not Label]
+        if self._lock:
+            self._flat = flat
+        return flat
+
     def _calc_position(self, offset=0):
-        for chunk in self._chunks:
-            if isinstance(chunk, Label):
-                #print "%07d:" % offset, chunk.key
-                self._positions[chunk.key] = offset
-            elif isinstance(chunk, LazyEvaluateArray):
-                offset = chunk._calc_position(offset)
+        # every chunk type knows its own size, Label records the offset
+        for event, chunk, owner in self._traverse():
+            if event is _CHUNK:
+                offset = chunk.layout(offset, owner)
+            elif event is _ENTER:
+                if owner is not None:
+                    chunk._owner = owner
+                chunk._offset = offset
             else:
-                offset += len(chunk)
+                chunk._size = offset - chunk._offset
         return offset
+
+    def layout(self, offset, lazyarray):
+        self._owner = lazyarray
+        return self._calc_position(offset)
+
+    def shift(self, delta, lazyarray):
+        for event, chunk, owner in self._traverse():
+            if event is _CHUNK:
+                chunk.shift(delta, owner)
+            elif event is _ENTER:
+                chunk._offset += delta
    
     def lock(self):
         self._calc_position()
         self._lock.append(True)
+        self._flattened()
         for key, value in self._variables.items():
             print "%20s:" % key, value
 
@@ -227,7 +578,109 @@ class LazyEvaluateArray(object):
         if not self._lock:
             raise RuntimeError(("This array is not locked. "
                                 "Run lock() method first"))
-        [chunk.write(writer, self) for chunk in self._chunks]
+        for chunk in self._flattened():
+            chunk.write(writer, self)
+
+    def write_file(self, file):
+        """Write to a seekable file in two steps: static data goes out in
+        order with zero-filled holes for the offsets, lengths and variables,
+        then every hole is patched with seek() + write().
+        """
+        if not self._lock:
+            raise RuntimeError(("This array is not locked. "
+                                "Run lock() method first"))
+        start = file.tell()
+        patches = []
+        offset = 0
+        for chunk in self._flattened():
+            if isinstance(chunk, VirtualChunk):
+                patches.append((offset, chunk))
+                file.write("\0" * chunk.length)
+            else:
+                chunk.write(file, self)
+            offset += len(chunk)
+        for patch_offset, chunk in patches:
+            file.seek(start + patch_offset)
+            chunk.write(file, self)
+        file.seek(start + offset)
+
+    def write_mmap(self, file, workers=1):
+        """Write to a file opened for update by mapping it into memory.
+
+        The file is resized to the final size, which is known after lock(),
+        and every chunk is copied to its own offset. With workers > 1 the
+        chunks are split over that many threads.
+        """
+        if not self._lock:
+            raise RuntimeError(("This array is not locked. "
+                                "Run lock() method first"))
+        start = file.tell()
+        end = start + self._size
+        file.truncate(end)
+        file.flush()
+        if not self._size:
+            return
+        memory = mmap.mmap(file.fileno(), end)
+        try:
+            tasks = []
+            offset = start
+            for chunk in self._flattened():
+                tasks.append((offset, chunk))
+                offset += len(chunk)
+
+            def write_tasks(tasks):
+                for offset, chunk in tasks:
+                    chunk.write(MemoryWriter(memory, offset), self)
+
+            if workers > 1 and len(tasks) > 1:
+                step = max(1, len(tasks) // (workers * 4))
+                pool = ThreadPool(workers)
+                try:
+                    pool.map(write_tasks, [tasks[i:i+step] for i in
+                                           xrange(0, len(tasks), step)])
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                write_tasks(tasks)
+        finally:
+            memory.close()
+        file.seek(end)
+
+    def layout_plan(self):
+        """Return a LayoutPlan that writes the same bytes as this locked
+        array. It can be saved and written again later without rebuilding
+        the tree, with different variable values.
+        """
+        if not self._lock:
+            raise RuntimeError(("This array is not locked. "
+                                "Run lock() method first"))
+        segments = []
+        span = OutputAsList()
+        for chunk in self._flattened():
+            if isinstance(chunk, HeaderChunk):
+                chunk = chunk.frozen(self)
+                if not chunk.header_layout.dynamic:
+                    chunk.write(span, self)
+                    continue
+            if isinstance(chunk, (Variable, HeaderChunk)) or \
+                    (isinstance(chunk, FileChunk) and
+                     isinstance(chunk.source, basestring)):
+                if span.result:
+                    segments.append("".join(span.result))
+                    del span.result[:]
+                if isinstance(chunk, FileChunk):
+                    # the plan may be written from another directory
+                    chunk = FileChunk(os.path.abspath(chunk.source),
+                                      chunk.offset, chunk.length)
+                segments.append(chunk)
+            else:
+                # offsets and lengths are fixed by now and files that
+                # are already open are copied into the plan
+                chunk.write(span, self)
+        if span.result:
+            segments.append("".join(span.result))
+        return LayoutPlan(segments, dict(self._variables))
 
     def as_list(self):
         output = OutputAsList()
@@ -240,20 +693,92 @@ class LazyEvaluateArray(object):
 
     def dump(self, indent=0):
         output_data = False
-        for chunk in self._chunks:
-            if isinstance(chunk, (DataChunk, str, unicode)):
+        indent -= 1
+        for event, chunk, owner in self._traverse():
+            if event is _ENTER:
+                indent += 1
+                output_data = False
+            elif event is _LEAVE:
+                indent -= 1
+                output_data = False
+            elif isinstance(chunk, DataChunk):
                 if not output_data:
-                    if isinstance(chunk, (str, unicode)):
-                        print "  " * indent, chunk
-                    else:
-                        print "  " * indent, chunk.dump()
+                    print "  " * indent, chunk.dump()
                 output_data = True
-            elif isinstance(chunk, LazyEvaluateArray):
-                chunk.dump(indent + 1)
             else:
                 output_data = False
                 print "  " * indent, chunk.dump()
 
+class LayoutPlan(object):
+    """Static byte spans, Variable slots and file references of a locked
+    LazyEvaluateArray, in output order.
+    """
+    format_version = 1
+
+    def __init__(self, segments, variables):
+        self.segments = segments
+        self._variables = variables
+
+    def find_variable(self, key):
+        return self._variables.get(key)
+
+    def set_variable(self, key, value):
+        if isinstance(value, unicode):
+            self._variables[key] = value.encode("utf-8")
+        else:
+            self._variables[key] = value
+
+    def variable_keys(self):
+        """Return the set of variable keys that have a slot in the plan."""
+        keys = set()
+        for segment in self.segments:
+            if isinstance(segment, Variable):
+                keys.add(segment.key)
+            elif isinstance(segment, HeaderChunk):
+                for index, kind in segment.header_layout.dynamic:
+                    if kind == "variable":
+                        keys.add(segment.values[index])
+        return keys
+
+    def write(self, writer):
+        for segment in self.segments:
+            if isinstance(segment, str):
+                writer.write(segment)
+            else:
+                segment.write(writer, self)
+
+    def save(self, path):
+        file = open(path, "wb")
+        try:
+            cPickle.dump((self.format_version, self.segments,
+                          self._variables), file, 2)
+        finally:
+            file.close()
+
+    @classmethod
+    def load(cls, path):
+        file = open(path, "rb")
+        try:
+            version, segments, variables = cPickle.load(file)
+        finally:
+            file.close()
+        if version != cls.format_version:
+            raise ValueError("%s was saved by another version" % path)
+        return cls(segments, variables)
+
+
+class MemoryWriter(object):
+    """Writer that copies into a mmap, starting at position."""
+    def __init__(self, memory, position):
+        self.memory = memory
+        self.position = position
+
+    def write(self, content):
+        end = self.position + len(content)
+        self.memory[self.position:end] = content
+        self.position = end
+
+
 class OutputAsList(object):
     def __init__(self):
         self.result = []
@@ -1,9 +1,16 @@
 #! -*- encoding: utf-8 -*-
 import os
+import sys
 import time
+import array
 import struct
+import tempfile
+import multiprocessing
 
-from lazyevaluatearray import LazyEvaluateArray
+from lazyevaluatearray import LazyEvaluateArray, LayoutPlan, HeaderLayout
+from lazyevaluatearray import VirtualChunk
+from compress_cache import CompressCache
+from atomic_file import write_atomically
 import palm_compress
 
 
@@ -42,98 +49,387 @@ _exth_types = {
     "updatedtitle":(503, None, None),
 }
 
+# EXTH records written as padded Variable slots ("exth " + name) of at least
+# this many bytes when a layout plan is saved, so that the plan can change
+# them
+_exth_slot_sizes = {
+    "publishingdate":32,
+    "versionnumber":16,
+    "lastupdatetime":32,
+}
+
+
+RECORD_SIZE = 4096
+TEXT_BATCH_SIZE = 256   # records compressed between two writes to the spool
+
+
+def text_records(text):
+    """Yield (record, overlap) for every RECORD_SIZE bytes of UTF-8 text.
+
+    Records are cut at fixed offsets. overlap holds the first bytes of the
+    next record that complete a character split by the cut. It goes into
+    the record's multibyte trailing entry (extra data flag bit 0).
+    """
+    size = len(text)
+    if not size:
+        yield text, ""
+        return
+    for start in xrange(0, size, RECORD_SIZE):
+        end = min(start + RECORD_SIZE, size)
+        yield text[start:end], _multibyte_overlap(text, start, end)
+
+
+def _multibyte_overlap(text, start, end):
+    lead = end - 1
+    while lead > start and lead > end - 4 and \
+            0x80 <= ord(text[lead]) < 0xc0:
+        lead -= 1
+    code = ord(text[lead])
+    if code >= 0xf0:
+        length = 4
+    elif code >= 0xe0:
+        length = 3
+    elif code >= 0xc0:
+        length = 2
+    else:
+        return ""
+    return text[end:lead+length]
+
+
+def file_text_records(path):
+    """Same as text_records(), reading the text from the file at path."""
+    file = open(path, "rb")
+    try:
+        chunk = file.read(RECORD_SIZE)
+        following = file.read(RECORD_SIZE)
+        while True:
+            if chunk:
+                overlap = _multibyte_overlap(chunk + following[:3], 0,
+                                             len(chunk))
+            else:
+                overlap = ""
+            yield chunk, overlap
+            if not following:
+                break
+            chunk = following
+            following = file.read(RECORD_SIZE)
+    finally:
+        file.close()
+
+
+def _compress_record(args):
+    # module level function, so that multiprocessing can pickle it
+    chunk, level = args
+    return palm_compress.compress(chunk, level)
+
+
+def _verify_record(args):
+    # returns the record index when it doesn't decode to the expected text
+    index, record, expected, compression_type = args
+    overlap = ord(record[-1]) & 3           # multibyte trailing entry
+    record = record[:-1-overlap]
+    if compression_type == 2:
+        try:
+            record = palm_compress.decompress(record)
+        except IndexError:
+            return index
+    if record != expected:
+        return index
+    return None
+
+
+def write_from_layout_plan(plan_path, output_path, **variables):
+    """Write a .azw again from a plan saved by MobiFileGenerator, without
+    the doctrees. Only variables (like "name" or "modification date") can
+    change, because everything else has a fixed position in the plan.
+
+    EXTH records listed in _exth_slot_sizes are variables too, named
+    "exth " + the record name (like "exth versionnumber"). They are only
+    padded to a fixed size when a plan is saved, so other builds keep the
+    plain values. A new value is padded with NUL bytes or cut to the size
+    of the slot. Raises KeyError for a variable the plan has no slot for.
+    """
+    plan = LayoutPlan.load(plan_path)
+    keys = plan.variable_keys()
+    for key, value in variables.items():
+        if key not in keys:
+            raise KeyError("%s has no variable %s" % (plan_path, key))
+        plan.set_variable(key, value)
+    write_atomically(output_path, plan.write)
+
 
 class MobiFileGenerator(LazyEvaluateArray):
     def init(self):
         self.name = None
-        self.texts = []
+        self.text_spool = tempfile.TemporaryFile()
+        self.text_lengths = array.array('I')
         self.images = []
         self.cover_image = None
+        self.compress_workers = 1
+        self.compress_cache = None
+        self.verify_output = False
+        self.source_text = None
+        self.source_path = None
+        self.layout_plan_path = None
+        self.exths = {}
+        self.output_mode = "stream"
+        self.fsync_output = False
+        self.compression_level = "normal"
+        self.set_variable("compression type", 2)
         self.record_count = 1
 
     def set_name(self, name):
         self.name = name
         self.set_variable("name", name)
     
+    def set_compress_workers(self, workers):
+        """Number of processes used by set_text(). 0 or None uses all CPUs."""
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        self.compress_workers = workers
+
+    def set_compress_cache(self, directory, max_size):
+        """Reuse compressed records from earlier builds kept in directory."""
+        self.compress_cache = CompressCache(directory, max_size)
+
+    def set_compression_level(self, level):
+        """"store" writes records uncompressed (PalmDOC compression type 1).
+        Other levels are the names in palm_compress.LEVELS.
+        """
+        if level == "store":
+            self.set_variable("compression type", 1)
+        elif level in palm_compress.LEVELS:
+            self.set_variable("compression type", 2)
+        else:
+            raise ValueError("unknown compression level: %s" % level)
+        self.compression_level = level
+
+    def set_layout_plan(self, path):
+        """Save the layout of the generated file to path. See
+        write_from_layout_plan().
+        """
+        self.layout_plan_path = path
+
+    def set_output_mode(self, mode):
+        """"stream" writes the file front to back, "mmap" maps the file at
+        its final size and copies the records in with compress_workers
+        threads.
+        """
+        if mode not in ("stream", "mmap"):
+            raise ValueError("unknown output mode: %s" % mode)
+        self.output_mode = mode
+
+    def set_fsync_output(self, fsync):
+        """fsync() the output before it is renamed into place."""
+        self.fsync_output = fsync
+
+    def set_verify_output(self, verify):
+        """Check the text records of the written file against the source."""
+        self.verify_output = verify
+
     def set_text(self, text):
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
         self.set_variable("text length", len(text))
-        all_texts = len(text)
-        compressing = 0
-        while True:
-            if len(text) > 4096:
-                print "compress: %d/%d" % (compressing, all_texts)
-                self.texts.append(palm_compress.compress(text[:4096]))
-                text = text[4096:]
-                compressing += 4096
-            else:
-                self.texts.append(palm_compress.compress(text))
-                break
+        if self.verify_output:
+            self.source_text = text
+        self._add_text_records(text_records(text))
+
+    def set_text_file(self, path):
+        """Same as set_text(), but reads the UTF-8 text from path one record
+        at a time instead of keeping it all in memory.
+        """
+        self.set_variable("text length", os.path.getsize(path))
+        if self.verify_output:
+            self.source_path = path
+        self._add_text_records(file_text_records(path))
+
+    def _add_text_records(self, records):
+        # compressed records go to text_spool; only their lengths are kept
+        pool = None
+        if self.compress_workers > 1 and \
+                self.compression_level != "store":
+            pool = multiprocessing.Pool(self.compress_workers)
+        try:
+            batch = []
+            for record in records:
+                batch.append(record)
+                if len(batch) == TEXT_BATCH_SIZE:
+                    self._write_text_records(batch, pool)
+                    batch = []
+            self._write_text_records(batch, pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        cache = self.compress_cache
+        if cache and self.compression_level != "store":
+            print "compress cache: %d hits, %d misses" % (cache.hits,
+                                                          cache.misses)
+            cache.trim()
+
+    def _write_text_records(self, batch, pool):
+        chunks = [chunk for chunk, overlap in batch]
+        level = self.compression_level
+        cache = self.compress_cache
+        if level == "store":
+            records = chunks
+        elif cache:
+            records = [cache.get(chunk, level) for chunk in chunks]
+        else:
+            records = [None] * len(chunks)
+        missing = [i for i, record in enumerate(records) if record is None]
+        compressed = self._compress([chunks[i] for i in missing], pool)
+        for i, record in zip(missing, compressed):
+            records[i] = record
+            if cache:
+                cache.set(chunks[i], record, level)
+        for record, (chunk, overlap) in zip(records, batch):
+            # overlapping bytes, then their count in the lowest 2 bits
+            record += overlap + chr(len(overlap))
+            self.text_spool.write(record)
+            self.text_lengths.append(len(record))
+        print "compress: %d/%d" % (len(self.text_lengths) * RECORD_SIZE,
+                                   self.find_variable("text length"))
+
+    def _compress(self, chunks, pool):
+        chunks = [(chunk, self.compression_level) for chunk in chunks]
+        if pool is not None and len(chunks) > 1:
+            # map() keeps the records in their original order
+            chunksize = max(1, len(chunks) // (self.compress_workers * 4))
+            return pool.map(_compress_record, chunks, chunksize)
+        return [_compress_record(chunk) for chunk in chunks]
     
     def set_images(self, images):
+        """images is a list of image file paths. They are copied into the
+        output while it is written, not read into memory.
+        """
         self.images = images
         
     def set_cover_image(self, image_path):
         self.cover_image = image_path
 
     def add_exth(self, key, value):
-        self.mobi_header.add_exth(key, value)
+        """Add an EXTH record. Call it before generate()."""
+        if key not in _exth_types:
+            raise KeyError("%s is not in valid exth name" % key)
+        self.exths[key] = value
     
     def generate(self, output_folder, basename):
+        text_count = len(self.text_lengths)
         self.pdb_header = self.sub_array(PalmDataBaseFormat)
         self.start_record()
         self.palmdoc_header = self.sub_array(PalmDocHeader)
-        self.mobi_header = self.sub_array(MobiHeader, args=[self.name])
+        self.mobi_header = self.sub_array(
+            MobiHeader,
+            args=[self.name, self.exths, bool(self.layout_plan_path)])
         
         if self.cover_image:
-            self.add_exth("coveroffset", 
-                len(self.texts) + len(self.images) + 2)
+            self.mobi_header.add_exth("coveroffset", 
+                text_count + len(self.images) + 2)
             self.set_variable("pdb record count", 
-                len(self.texts) + len(self.images) + 3)
+                text_count + len(self.images) + 3)
         else:
             self.set_variable("pdb record count", 
-                len(self.texts) + len(self.images) + 2)
-        self.set_variable("palmdoc record count", len(self.texts))
-        self.set_variable("first non book index", len(self.texts)+2)
-        self.set_variable("first image index", len(self.texts)+2)
+                text_count + len(self.images) + 2)
+        self.set_variable("palmdoc record count", text_count)
+        self.set_variable("first non book index", text_count+2)
+        self.set_variable("first image index", text_count+2)
         
         self.end_record()
         
-        for text in self.texts:
+        offset = 0
+        for length in self.text_lengths:
             self.start_record()
-            self.data(text)
-            self.data("B", 0)
+            self.file_data(self.text_spool, offset, length)
             self.end_record()
+            offset += length
         
         for image in self.images:
             self.start_record()
-            self.data(image)
+            self.file_data(image)
             self.end_record()
         
         if self.cover_image:
             self.start_record()
-            self.data(open(self.cover_image, "rb"))
+            self.file_data(self.cover_image)
             self.end_record()
         
         self.generate_eof_record()
         
         self.lock()
-        #for key, value in self._positions.items():
-        #    if "start" in key:
-        #        print key, value
+        #for key, handle in self._named_labels.items():
+        #    print key, self.find_position(handle)
         
-        file = open(os.path.join(output_folder, basename + ".azw"), "wb")
-        self.write(file)
-        file.close()
+        path = os.path.join(output_folder, basename + ".azw")
+        def write(file):
+            if self.output_mode == "mmap":
+                self.write_mmap(file, self.compress_workers)
+            else:
+                self.write_file(file)
+            if self.verify_output:
+                # still the temporary file: a broken one is never renamed
+                # into place
+                self.verify(file)
+        write_atomically(path, write, self.fsync_output)
+        if self.layout_plan_path:
+            self.layout_plan().save(self.layout_plan_path)
+        self.text_spool.close()
+
+    def verify(self, file):
+        """Decompress every text record in file, which is open for reading
+        and starts with the .azw, and compare it with the text given to
+        set_text() or set_text_file(). Raises ValueError at the first
+        mismatch.
+        """
+        tasks = self._verify_tasks(file)
+        index = None
+        if self.compress_workers > 1 and len(self.text_lengths) > 1:
+            pool = multiprocessing.Pool(min(self.compress_workers,
+                                            len(self.text_lengths)))
+            try:
+                for index in pool.imap_unordered(_verify_record, tasks, 8):
+                    if index is not None:
+                        pool.terminate()
+                        break
+                else:
+                    pool.close()
+            finally:
+                pool.join()
+        else:
+            for task in tasks:
+                index = _verify_record(task)
+                if index is not None:
+                    break
+        if index is not None:
+            raise ValueError("text record %d doesn't match the source text"
+                             % index)
+        print "verify: %d text records OK" % len(self.text_lengths)
+
+    def _verify_tasks(self, file):
+        compression_type = self.find_variable("compression type")
+        if self.source_path:
+            sources = file_text_records(self.source_path)
+        else:
+            sources = text_records(self.source_text)
+        file.seek(0)
+        header = file.read(78 + 8 * (len(self.text_lengths) + 2))
+        offsets = [struct.unpack("!I", header[78+8*i:82+8*i])[0]
+                   for i in xrange(len(self.text_lengths) + 2)]
+        for i, (expected, overlap) in enumerate(sources):
+            file.seek(offsets[i+1])
+            record = file.read(offsets[i+2] - offsets[i+1])
+            yield i + 1, record, expected, compression_type
         
     def start_record(self):
         i = self.record_count
-        self.label("pdb record/%d:start" % i)
+        self.record_start = self.new_label(("pdb record", i, "start"))
+        self.label(self.record_start)
         #self.data("B", 0)
-        #self.length("pdb record/%d:start" % i, "pdb record/%d:end" % i, 4)
-        self.pdb_header.append_record_entry(i)
+        self.pdb_header.append_record_entry(i, self.record_start)
 
     def end_record(self):
-        self.label("pdb record/%d:end" % self.record_count)
+        self.label(self.new_label(("pdb record", self.record_count, "end")))
         self.record_count += 1
 
     def generate_eof_record(self):
@@ -145,80 +441,130 @@ class MobiFileGenerator(LazyEvaluateArray):
         self.end_record()
 
 
+_PDB_HEADER = HeaderLayout([
+    ("variable", "32s", "name"),
+    ("data", "H", 0),                           # attrs
+    ("data", "H", 0),                           # version
+    ("variable", "I", "creation date"),
+    ("variable", "I", "modification date"),
+    ("data", "I", 0),                           # last backup date
+    ("data", "I", 0),                           # Modification number
+    ("data", "I", 0),                           # App info ID
+    ("data", "I", 0),                           # Sort info ID
+    ("data", "4s", "BOOK"),                     # type
+    ("data", "4s", "MOBI"),                     # creater
+    ("variable", "I", "pdb record count"),      # unique ID Seed
+    ("data", "I", 0),                           # next record list id
+    ("variable", "H", "pdb record count"),      # record count
+])
+
+
 class PalmDataBaseFormat(LazyEvaluateArray):
     def init(self):
-        self.variable("name", 32)
-        self.data("!H", 0)                      # attrs
-        self.data("!H", 0)                      # version
-        self.data("!I", int(time.time()))       # creation date
-        self.data("!I", int(time.time()))       # modification date
-        self.data("!I", 0)                      # last backup date
-        self.data("!I", 0)                      # Modification number
-        self.data("!I", 0)                      # App info ID
-        self.data("!I", 0)                      # Sort info ID
-        self.data("BOOK")                       # type
-        self.data("MOBI")                       # creater
-        self.variable("pdb record count", 4)    # unique ID Seed
-        self.data("!I", 0)                      # next record list id
-        self.variable("pdb record count", 2)    # record count
-        self.record_entries = self.sub_array()
+        self.set_variable("creation date", int(time.time()))
+        self.set_variable("modification date", int(time.time()))
+        self.header(_PDB_HEADER)
+        self.record_table = PdbRecordTable()
+        self._chunks.append(self.record_table)
         self.data("!H", 0)                      # aditionally 2 zero bytes
     
-    def append_record_entry(self, record_index):
-        self.record_entries.offset("pdb record/%d:start" % record_index, 4)
-        self.record_entries.data("!B", 0)              # attribute
-        a = struct.pack("!I", record_index-1)
-        self.record_entries.data(struct.pack("!I", record_index-1)[1:])
+    def append_record_entry(self, record_index, start_label):
+        self.lock_check()
+        self.record_table.append(record_index - 1,
+                                 self.label_handle(start_label))
+
+
+class PdbRecordTable(VirtualChunk):
+    """The PDB record list: 4 bytes offset, 1 byte attribute and 3 bytes
+    unique ID for every record. Entries are kept in arrays and the whole
+    table is packed in one pass when it is written.
+    """
+    def __init__(self):
+        self.labels = array.array('I')      # label index of each record
+        self.unique_ids = array.array('I')
+        super(PdbRecordTable, self).__init__(0)
+
+    def append(self, unique_id, start_label):
+        self.labels.append(start_label.index)
+        self.unique_ids.append(unique_id & 0xffffff)   # attribute is 0
+        self.length += 8
+
+    def write(self, writer, lazyarray):
+        positions = lazyarray._label_positions
+        offsets = [positions[index] for index in self.labels]
+        if None in offsets:
+            raise ValueError("record %d has no start label" % (
+                offsets.index(None) + 1))
+        table = array.array('I', [0]) * (2 * len(offsets))
+        table[0::2] = array.array('I', offsets)
+        table[1::2] = self.unique_ids
+        if sys.byteorder == "little":
+            table.byteswap()
+        writer.write(table.tostring())
+
+    def dump(self):
+        return "PDB record table: %d entries" % len(self.labels)
+
+
+_PALMDOC_HEADER = HeaderLayout([
+    ("variable", "H", "compression type"),      # 1 = none, 2 = PalmDOC
+    ("data", "H", 0),                           # unused
+    ("variable", "I", "text length"),
+    ("variable", "H", "palmdoc record count"),
+    ("data", "H", RECORD_SIZE),                 # record size
+    ("data", "I", 0),                           # current reading position
+])
 
 
 class PalmDocHeader(LazyEvaluateArray):
     def init(self):
         self.label("pdb header:start")
-        self.data("!H", 2)                   # 2 = PalmDOC compression
-        self.data("!H", 0)                   # unused
-        self.variable("text length", 4)
-        self.variable("palmdoc record count", 2)
-        self.data("!H", 4096)                # record size
-        self.data("!I", 0)                   # current reading position
+        self.header(_PALMDOC_HEADER)
         self.label("pdb header:end")
 
 
+_MOBI_HEADER = HeaderLayout([
+    ("data", "4s", "MOBI"),
+    ("length", "I", ("mobi header:start", "mobi header:end")),
+    ("data", "I", 2),                           # Mobi Type
+    ("variable", "I", "text encoding", 65001),
+    ("unique", "I"),
+    ("variable", "I", "generator version", 6),
+    ("data", "40s", "\xff" * 40),
+    ("variable", "I", "first non book index"),
+    ("offset", "I", "full name:start"),
+    ("length", "I", ("full name:start", "full name:end")),
+    # see http://msdn.microsoft.com/ja-jp/library/cc398328.aspx
+    ("variable", "I", "locale code", 0x0409),
+    ("variable", "I", "input lang", 0),
+    ("variable", "I", "output lang", 0),
+    ("variable", "I", "format version", 6),
+    ("variable", "I", "first image index"),
+    ("data", "16s", ""),
+    ("variable", "I", "exth flag", 0x40),
+    ("data", "36s", ""),
+    ("variable", "I", "DRM offset", 0xffffffff),
+    ("variable", "H", "DRM count", 0),
+    ("variable", "H", "DRM size", 0),
+    ("variable", "I", "DRM flag", 0),
+    ("data", "62s", ""),
+    ("variable", "H", "extra data flag", 1),    # multibyte overlap
+])
+
+
 class MobiHeader(LazyEvaluateArray):
-    def init(self, fullname):
+    def init(self, fullname, exths, exth_slots=False):
         self.exths = {}
         for key, (typeid, format, default) in _exth_types.items():
             if default is not None:
                 self.exths[key] = default
+        self.exths.update(exths)
         self._generate_header()
-        self._generate_exth(fullname)
+        self._generate_exth(fullname, exth_slots)
     
     def _generate_header(self):
         self.label("mobi header:start")
-        self.data("MOBI")
-        self.length("mobi header:start", "mobi header:end", 4)
-        self.data("!I", 2)                       # Mobi Type
-        self.variable("text encoding", 4, default=65001)
-        self.data("!I", self.unique_number())
-        self.variable("generator version", 4, default=6)    
-        self.reserve(0xff, 40)
-        self.variable("first non book index", 4)
-        self.offset("full name:start", 4)
-        self.length("full name:start", "full name:end", 4)
-        self.variable("locale code", 4, default=0x0409) 
-        # see http://msdn.microsoft.com/ja-jp/library/cc398328.aspx
-        self.variable("input lang", 4, default=0)
-        self.variable("output lang", 4, default=0)
-        self.variable("format version", 4, default=6)
-        self.variable("first image index", 4)
-        self.reserve(0, 16)
-        self.variable("exth flag", 4, default=0x40)
-        self.reserve(0, 36)
-        self.variable("DRM offset", 4, default=0xffffffff)
-        self.variable("DRM count", 2, default=0)
-        self.variable("DRM size", 2, default=0)
-        self.variable("DRM flag", 4, default=0)
-        self.reserve(0, 62)
-        self.variable("extra data flag", 2, default=0)
+        self.header(_MOBI_HEADER)
         self.label("mobi header:end")
 
     def add_exth(self, typename, value):
@@ -227,7 +573,7 @@ class MobiHeader(LazyEvaluateArray):
         else:
             raise KeyError("%s is not in valid exth name" % typename)
     
-    def _generate_exth(self, fullname):
+    def _generate_exth(self, fullname, exth_slots):
         self.label("exth record:start")
         self.data("EXTH")
         self.length("exth record:start", "exth record:end", 4)
@@ -235,11 +581,19 @@ class MobiHeader(LazyEvaluateArray):
         
         for i, (typename, value) in enumerate(self.exths.items()):
             index = i + 1
-            self.label("exth record/%d:start" % index)
+            start = self.new_label(("exth record", index, "start"))
+            end = self.new_label(("exth record", index, "end"))
+            self.label(start)
             self.data("!I", _exth_types[typename][0])
-            self.length("exth record/%d:start" % index, "exth record/%d:end" % index, 4)
-            self.data(value)
-            self.label("exth record/%d:end" % index)
+            self.length(start, end, 4)
+            if exth_slots and typename in _exth_slot_sizes:
+                if isinstance(value, unicode):
+                    value = value.encode("utf-8")
+                size = max(_exth_slot_sizes[typename], len(value))
+                self.variable("exth " + typename, size, default=value)
+            else:
+                self.data(value)
+            self.label(end)
 
         self.label("exth record:end")
         self.label("full name:start")
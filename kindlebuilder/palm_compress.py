@@ -1,150 +1,217 @@
 # -*- encoding: sjis -*-
 
-import collections
+import os
 import array
+import ctypes
 
-def compress(bytes):
-    chunks = collections.deque()
-    position = len(bytes)
-    while position > 0:
-        windowchunk = window(bytes, position)
-        textchunk = text(bytes, windowchunk.last, position)
-        if textchunk:
-            chunks.appendleft(textchunk)
-        if windowchunk:
-            chunks.appendleft(windowchunk)
+WINDOW_SIZE = 2047      # largest distance an 11-bit offset can express
+MIN_MATCH = 3
+MAX_MATCH = 10
+
+# level name: (window size, number of candidates tried per position).
+# "fast" takes the nearest earlier copy, "normal" the longest in the window.
+# "optimal" searches like "normal", then picks the commands with
+# optimal_compress() instead of greedily.
+LEVELS = {
+    "fast": (256, 1),
+    "normal": (WINDOW_SIZE, 0),
+    "optimal": (WINDOW_SIZE, 0),
+}
+
+# commands chosen by optimal_compress()
+_SINGLE, _TYPE_A, _TYPE_B, _TYPE_C = range(4)
+
+
+def compress(bytes, level="normal"):
+    """Compress one record with PalmDOC LZ77 in a single forward pass.
+
+    Matches are found through hash chains keyed by 3-byte prefixes, and all
+    codes are written straight into one preallocated bytearray.
+    """
+    if level == "optimal":
+        return optimal_compress(bytes)
+    window_size, max_chain = LEVELS[level]
+    data = bytearray(bytes)
+    size = len(data)
+    # worst case is a type A escape (1 count byte) for every 8 bytes
+    output = bytearray(size + (size >> 3) + 1)
+    head = {}
+    chain = array.array('i', [-1]) * size
+    position = 0
+    out = 0
+    run = -1            # index of the open type A count byte in output
+    while position < size:
+        code = data[position]
+        match_length = 0
+        if position + MIN_MATCH <= size:
+            key = (code << 16) | (data[position+1] << 8) | data[position+2]
+            candidate = head.get(key, -1)
+            chain[position] = candidate
+            head[key] = position
+            limit = min(MAX_MATCH, size - position)
+            tries = max_chain or size
+            while candidate >= 0 and position - candidate <= window_size:
+                length = MIN_MATCH
+                while length < limit and \
+                        data[candidate+length] == data[position+length]:
+                    length += 1
+                if length > match_length:
+                    match_length = length
+                    distance = position - candidate
+                    if length == limit:
+                        break
+                tries -= 1
+                if not tries:
+                    break
+                candidate = chain[candidate]
+        if match_length:
+            # "Type B" command: distance and length of the earlier copy
+            value = 0x8000 | (distance << 3) | (match_length - MIN_MATCH)
+            output[out] = value >> 8
+            output[out+1] = value & 0xff
+            out += 2
+            run = -1
+            _insert(data, head, chain, position + 1, position + match_length)
+            position += match_length
+        elif code == 32 and position + 1 < size and \
+                0x40 <= data[position+1] < 0x80:
+            # "Type C" command: space + character
+            output[out] = data[position+1] ^ 0x80
+            out += 1
+            run = -1
+            _insert(data, head, chain, position + 1, position + 2)
+            position += 2
+        elif run < 0 and (code == 0 or 0x09 <= code < 0x80):
+            # single output
+            output[out] = code
+            out += 1
+            position += 1
         else:
-            chunks.appendleft(text(bytes, 0, position))
-        position = windowchunk.start
-    byte_array = array.array('B')
-    [chunk.write(byte_array) for chunk in chunks]
-    return byte_array.tostring()
-
-
-class window(object):
-    def __init__(self, bytes, position):
-        self.last = position
-        self.find = False
-        self.bytes = bytes
-        while position >= 3:
-            index, length = self.search_window(position)
-            if length:
-                self.start = position - length
-                self.offset = self.start - index
-                self.last = position
-                self.find = True
-                break
-            position -= 1
+            # "Type A" command: up to 8 bytes escaped by a count byte
+            if run < 0:
+                run = out
+                output[out] = 0
+                out += 1
+            output[run] += 1
+            output[out] = code
+            out += 1
+            position += 1
+            if output[run] == 8:
+                run = -1
+    return str(output[:out])
+
+
+def _insert(data, head, chain, start, end):
+    # register positions skipped by a command so later matches can use them
+    for position in xrange(start, min(end, len(data) - MIN_MATCH + 1)):
+        key = (data[position] << 16) | (data[position+1] << 8) | \
+              data[position+2]
+        chain[position] = head.get(key, -1)
+        head[key] = position
+
+
+def _longest_matches(data, window_size):
+    """Return the length and distance of the longest earlier copy at every
+    position (length 0 when there is none).
+    """
+    size = len(data)
+    lengths = array.array('i', [0]) * size
+    distances = array.array('i', [0]) * size
+    head = {}
+    chain = array.array('i', [-1]) * size
+    for position in xrange(size - MIN_MATCH + 1):
+        key = (data[position] << 16) | (data[position+1] << 8) | \
+              data[position+2]
+        candidate = head.get(key, -1)
+        chain[position] = candidate
+        head[key] = position
+        limit = min(MAX_MATCH, size - position)
+        best = 0
+        while candidate >= 0 and position - candidate <= window_size:
+            length = MIN_MATCH
+            while length < limit and \
+                    data[candidate+length] == data[position+length]:
+                length += 1
+            if length > best:
+                best = length
+                distances[position] = position - candidate
+                if length == limit:
+                    break
+            candidate = chain[candidate]
+        lengths[position] = best
+    return lengths, distances
+
+
+def optimal_compress(bytes):
+    """Compress one record into the smallest possible PalmDOC stream.
+
+    cost[i] is the smallest output for bytes[i:]. It is computed from the end
+    of the record, trying single bytes, type A escapes of 1 to 8 bytes, type
+    C space pairs and every length of the longest back-reference. The
+    cheapest commands are then written from the start.
+    """
+    data = bytearray(bytes)
+    size = len(data)
+    lengths, distances = _longest_matches(data, LEVELS["optimal"][0])
+    cost = array.array('i', [0]) * (size + 1)
+    commands = bytearray(size)
+    steps = bytearray(size)
+    for position in xrange(size - 1, -1, -1):
+        code = data[position]
+        if code == 0 or 0x09 <= code < 0x80:
+            best = cost[position+1] + 1
+            command, step = _SINGLE, 1
         else:
-            self.start = 0
-
-    def write(self, byte_array):
-        length = self.last - self.start
-        bytes = 0x80 * 256 + ((self.offset) << 3) + length - 3
-        byte_array.append(bytes >> 8)
-        byte_array.append(bytes & 0xff)
-        
-    def __str__(self):
-        return "<%s, %d, %d>" % (self.bytes[self.start-self.offset:self.last-self.offset], 
-            self.offset, self.last-self.start)
-
-    def __nonzero__(self):
-        return self.find 
-       
-    def search_window(self, position): 
-        for length in xrange(10, 2, -1):
-            end_point = position - length
-            if end_point < length:
-                break
-            start_point = max(0, end_point - 2048)
-            search_word = self.bytes[position-length:position]
-            index = self.bytes.rfind(search_word, start_point, end_point)
-            if index != -1:
-                return index, length
-        return None, None
-
-
-class text(object):
-    OTHER = 0
-    TYPE_A = 1
-    TYPE_C = 2
-    
-    def __init__(self, bytes, start, end):
-        self.start = start
-        self.end = end
-        self.bytes = bytes
-        self.array = array.array('B')
-        self.compress(bytes[start:end])
-    
-    def _check_type(self, bytes, index):
-        first = ord(bytes[index])
-        if first == 32:
-            try:
-                second = ord(bytes[index+1])
-            except IndexError:
-                pass
-            else:
-                if second in xrange(64, 128):
-                    return self.TYPE_C, 0x80 ^ second
-        if first == 0 or first in xrange(9, 127):
-            return self.OTHER, first
-        return self.TYPE_A, first
-    
-    def _type_a(self, bytes, index):
-        code = ord(bytes[index])
-        if code == 0 or code in xrange(9, 127):
-            return code
+            best = cost[position+1] + 2
+            command, step = _TYPE_A, 1
+        if code == 32 and position + 1 < size and \
+                0x40 <= data[position+1] < 0x80 and \
+                cost[position+2] + 1 < best:
+            best = cost[position+2] + 1
+            command, step = _TYPE_C, 2
+        for length in xrange(lengths[position], MIN_MATCH - 1, -1):
+            if cost[position+length] + 2 < best:
+                best = cost[position+length] + 2
+                command, step = _TYPE_B, length
+        for count in xrange(2, min(8, size - position) + 1):
+            if cost[position+count] + count + 1 < best:
+                best = cost[position+count] + count + 1
+                command, step = _TYPE_A, count
+        cost[position] = best
+        commands[position] = command
+        steps[position] = step
+
+    output = bytearray(cost[0])
+    position = 0
+    out = 0
+    while position < size:
+        command = commands[position]
+        step = steps[position]
+        if command == _SINGLE:
+            output[out] = data[position]
+            out += 1
+        elif command == _TYPE_C:
+            output[out] = data[position+1] ^ 0x80
+            out += 1
+        elif command == _TYPE_B:
+            value = 0x8000 | (distances[position] << 3) | (step - MIN_MATCH)
+            output[out] = value >> 8
+            output[out+1] = value & 0xff
+            out += 2
         else:
-            return None
-    
-    def compress(self, bytes):
-        type_a = []
-        skip = False
-        def merge_buffer():
-            if type_a:
-                self.array.append(len(type_a))
-                [self.array.append(code) for code in type_a]
-                del type_a[:]
-
-        for i in xrange(len(bytes)):
-            if skip:
-                skip = False
-                continue
-            type, code = self._check_type(bytes, i)
-            if type == self.TYPE_C:
-                merge_buffer()
-                self.array.append(code)
-                skip = True
-            elif type == self.TYPE_A:
-                type_a.append(code)
-                if len(type_a) == 8:
-                    merge_buffer()
-            else:
-                if type_a:
-                    type_a.append(code)
-                    if len(type_a) == 8:
-                        merge_buffer()
-                else:
-                    self.array.append(code)
-        merge_buffer()
-    
-    def write(self, byte_array):
-        [byte_array.append(char) for char in self.array]
-
-    def __nonzero__(self):
-        return self.start != self.end
-    
-    def __str__(self):
-        return self.bytes[self.start:self.end]
+            output[out] = step
+            output[out+1:out+1+step] = data[position:position+step]
+            out += step + 1
+        position += step
+    return str(output)
 
 
 def decompress(bytes):
+    bytes = bytearray(bytes)
     blen = len(bytes)
-    bytes = [ord(c) for c in bytes] # comvert byte to int array
-    result_array = array.array('B')
+    result_array = bytearray()
     outlen = 6000
     i = 0
-    j = 0
     while i < blen:
         c = bytes[i]
         i += 1
@@ -152,38 +219,89 @@ def decompress(bytes):
             # "Type C" command
             result_array.append(32) # ' '
             result_array.append(c & 0x7f)
-            j += 2
         elif c >= 0x80:
             # "Type B" command
             c = (c << 8) | bytes[i]
             i += 1
+            j = len(result_array)
             wdist = (c >> 3) & 0x07ff # Slide window position
             wcopy = j - wdist # Output buffer and slide window
             wlen = min((c & 7) + 3, outlen - j)
-            for _ in xrange(0, wlen):
-                result_array.append(result_array[wcopy])
-                j += 1
-                wcopy += 1
-
-        elif c >= 0x09:
+            if 0 <= wcopy and wlen <= wdist:
+                # the source does not overlap the output: copy a slice
+                result_array += result_array[wcopy:wcopy+wlen]
+            else:
+                for _ in xrange(0, wlen):
+                    result_array.append(result_array[wcopy])
+                    wcopy += 1
+        elif c >= 0x09 or c == 0:
             # Single output
             result_array.append(c)
-            j += 1
-
-        elif c >= 0x01:
-            # Repeated output
-            c = min(c, outlen - j)
-            for _ in xrange(0, c):
-                result_array.append(bytes[i])
-                i += 1
-                j += 1
-   
         else:
-            # Single output
-            result_array.append(c)
-            j += 1
+            # Repeated output
+            c = min(c, outlen - len(result_array))
+            if c > 0:
+                if i + c > blen:
+                    raise IndexError("literal run is out of the record")
+                result_array += bytes[i:i+c]
+                i += c
+
+    return str(result_array)
+
 
-    return result_array.tostring()
+py_compress = compress
+py_decompress = decompress
+
+
+def _load_library():
+    """Load the optional C codec built from _palmdoc.c, if there is one."""
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for filename in ("_palmdoc.so", "_palmdoc.dylib", "_palmdoc.dll"):
+        path = os.path.join(folder, filename)
+        if not os.path.exists(path):
+            continue
+        try:
+            library = ctypes.CDLL(path)
+        except OSError:
+            continue
+        for function in (library.palmdoc_compress,
+                         library.palmdoc_decompress):
+            function.restype = ctypes.c_long
+        library.palmdoc_compress.argtypes = (
+            ctypes.c_char_p, ctypes.c_long, ctypes.c_char_p,
+            ctypes.c_long, ctypes.c_long)
+        library.palmdoc_decompress.argtypes = (
+            ctypes.c_char_p, ctypes.c_long, ctypes.c_char_p)
+        return library
+    return None
+
+
+def c_compress(bytes, level="normal"):
+    if level == "optimal":
+        return py_compress(bytes, level)
+    window_size, max_chain = LEVELS[level]
+    size = len(bytes)
+    output = ctypes.create_string_buffer(size + (size >> 3) + 1)
+    length = _library.palmdoc_compress(bytes, size, output,
+                                       window_size, max_chain)
+    if length < 0:
+        return py_compress(bytes, level)
+    return output.raw[:length]
+
+
+def c_decompress(bytes):
+    output = ctypes.create_string_buffer(6000 + 2 * len(bytes))
+    length = _library.palmdoc_decompress(bytes, len(bytes), output)
+    if length < 0:
+        # broken input: let the Python code raise the usual error
+        return py_decompress(bytes)
+    return output.raw[:length]
+
+
+_library = _load_library()
+if _library is not None:
+    compress = c_compress
+    decompress = c_decompress
 
 
 def test():
@@ -219,6 +337,16 @@ def test():
         print "OK"
     else:
         print repr(result)
+    if _library is not None:
+        # the C codec must give the same bytes as the Python one
+        for level in sorted(LEVELS):
+            archive = py_compress(sample, level)
+            if c_compress(sample, level) != archive:
+                print "C compress differs:", level
+            elif c_decompress(archive) != py_decompress(archive):
+                print "C decompress differs:", level
+            else:
+                print "C codec OK:", level
 
 if __name__ == "__main__":
     test()